@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'jenfimail.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -132,3 +133,27 @@ env = environ.Env()
 environ.Env.read_env()
 
 TRAIN_TRAVEL_TIME_HRS = int(env('TRAIN_TRAVEL_TIME_HRS'))
+
+# status cache: 'local' keeps an LRU per process, 'django' uses the CACHES alias below (e.g. redis shared by all workers)
+STATUS_CACHE_BACKEND = env('STATUS_CACHE_BACKEND', default='local')
+STATUS_CACHE_ALIAS = env('STATUS_CACHE_ALIAS', default='default')
+STATUS_CACHE_TTL_SECS = float(env('STATUS_CACHE_TTL_SECS', default=60))
+STATUS_CACHE_MAX_SIZE = int(env('STATUS_CACHE_MAX_SIZE', default=10000))
+
+# instrumentation: every call is timed, the sampled share also counts queries and solver time and is logged as json
+INSTRUMENTATION_ENABLED = env.bool('INSTRUMENTATION_ENABLED', default=True)
+INSTRUMENTATION_SAMPLE_RATE = float(env('INSTRUMENTATION_SAMPLE_RATE', default=0.01))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'message': { 'format': '%(message)s' },
+    },
+    'handlers': {
+        'instrumentation': { 'class': 'logging.StreamHandler', 'formatter': 'message' },
+    },
+    'loggers': {
+        'jenfimail.instrumentation': { 'handlers': ['instrumentation'], 'level': env('INSTRUMENTATION_LOG_LEVEL', default='INFO'), 'propagate': False },
+    },
+}
@@ -1,7 +1,7 @@
 
 from django.contrib import admin
 from django.urls import path
-from jenfimail.views import LineView, TrainView, ParcelView, index, bid_train, withdraw_train, get_train_status, deposit_parcel, get_parcel_status, withdraw_parcel, ship_train
+from jenfimail.views import LineView, TrainView, ParcelView, index, bid_train, withdraw_train, get_train_status, deposit_parcel, deposit_parcels, get_parcel_status, withdraw_parcel, ship_train, schedule_shipments, export_parcels, export_shipments, get_parcel_statuses, get_train_statuses, aget_parcel_status, aget_train_status, alist_trains, alist_parcels, metrics
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -14,9 +14,24 @@ urlpatterns = [
     path('api/', index),
     path('api/trains/bid/', bid_train),
     path('api/parcels/deposit/', deposit_parcel),
+    path('api/parcels/deposit/bulk/', deposit_parcels),
+    path('api/parcels/status', get_parcel_statuses),
     path('api/parcels/<int:parcel_id>/status/', get_parcel_status),
     path('api/parcels/<int:parcel_id>/withdraw/', withdraw_parcel),
     path('api/trains/<int:train_id>/withdraw/', withdraw_train),
+    path('api/trains/status', get_train_statuses),
     path('api/trains/<int:train_id>/status/', get_train_status),
     path('api/trains/<int:train_id>/ship/<int:line_id>/', ship_train),
+    path('api/schedule/', schedule_shipments),
+    path('api/export/parcels', export_parcels),
+    path('api/export/shipments', export_shipments),
+
+    # async read endpoints, served natively under ASGI (jenfiexam.asgi)
+    path('async/trains/', alist_trains),
+    path('async/parcels/', alist_parcels),
+    path('api/async/parcels/<int:parcel_id>/status/', aget_parcel_status),
+    path('api/async/trains/<int:train_id>/status/', aget_train_status),
+
+    # prometheus scrape target
+    path('metrics', metrics),
 ]
@@ -0,0 +1,3 @@
+from .generators import BenchDataGenerator
+from .runner import BenchmarkRunner, QueryCounter
+from .cases import BenchContext, CASES, get_cases
@@ -0,0 +1,77 @@
+from ..models import Line, Parcel
+from ..services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService, line_availability_index
+
+class BenchContext():
+    """ Services plus the ids every case works on, picked once the data is seeded. """
+
+    def __init__(self, generator, **args):
+        self.generator = generator
+        self.batch_size = int(args.get('batch_size', 1000))
+
+        self.train_service = TrainOperatorService()
+        self.parcel_service = ParcelService()
+        self.optimizer_service = OptimizerService(solver=args.get('solver', OptimizerService.SOLVER_CBC), time_limit=args.get('time_limit'))
+        self.post_master_service = PostMasterService(self.train_service, self.parcel_service, self.optimizer_service)
+
+    def prepare(self):
+        # one real shipment, so the shipped paths have something to read
+        self.shipment = None
+        for train in self.train_service.get_available_trains().order_by('-weight_capacity'):
+            line = train.lines.first()
+            if self.parcel_service.is_fillable(train.capacity) and self.post_master_service.is_line_available(line):
+                self.shipment = self.post_master_service.ship_train(train, line)
+                break
+        # the index only learns of the shipment once it commits, the database already knows
+        line_availability_index.load()
+
+        self.open_trains = list(self.train_service.get_available_trains().order_by('id'))
+        self.lines = list(Line.objects.all().order_by('id'))
+        self.capacity = (max([train.weight_capacity for train in self.open_trains]), max([train.volume_capacity for train in self.open_trains]))
+        self.ship_target = self.get_ship_target()
+
+        self.pending_parcel_id = Parcel.objects.filter(shipment=None, withdrawn_at=None).values_list('id', flat=True).first()
+        self.parcel_ids = list(Parcel.objects.values_list('id', flat=True).order_by('id')[:self.batch_size])
+        self.train_ids = [train.id for train in self.open_trains][:self.batch_size]
+        self.deposit_batch = self.generator.parcel_data(self.batch_size, offset=10 ** 9)
+        self.train_bid = dict(self.generator.train_data(1, self.lines)[0], lines=[self.lines[0].name])
+        return self
+
+    def get_ship_target(self):
+        for train in self.open_trains:
+            for line in train.lines.all():
+                if line_availability_index.is_available(line.id) and self.parcel_service.is_fillable(train.capacity):
+                    return (train, line)
+        return None
+
+    def get_parcels(self):
+        return self.parcel_service.get_parcels_within_capacity(self.capacity)
+
+# name -> case; names follow the service method being timed
+CASES = {
+    'ParcelService.deposit_parcel': lambda context: context.parcel_service.deposit_parcel(context.deposit_batch[0]),
+    'ParcelService.deposit_parcels': lambda context: context.parcel_service.deposit_parcels(context.deposit_batch),
+    'ParcelService.withdraw_parcel': lambda context: context.parcel_service.withdraw_parcel(context.pending_parcel_id),
+    'ParcelService.get_parcel_status': lambda context: context.parcel_service.get_parcel_status(context.parcel_ids[0]),
+    'ParcelService.get_parcel_statuses': lambda context: context.parcel_service.get_parcel_statuses(context.parcel_ids),
+    'ParcelService.is_fillable': lambda context: context.parcel_service.is_fillable(context.capacity),
+    'ParcelService.get_parcels_to_fill_capacity': lambda context: context.parcel_service.get_parcels_to_fill_capacity(context.capacity),
+    'ParcelService.get_parcels_to_fill_capacities': lambda context: context.parcel_service.get_parcels_to_fill_capacities([train.capacity for train in context.open_trains[:10]]),
+    'BacklogService.get_load_within': lambda context: context.parcel_service.backlog.get_load_within(context.capacity),
+    'TrainOperatorService.bid_train': lambda context: context.train_service.bid_train(context.train_bid),
+    'TrainOperatorService.withdraw_train': lambda context: context.train_service.withdraw_train(context.open_trains[0].id),
+    'TrainOperatorService.get_available_trains': lambda context: list(context.train_service.get_available_trains()),
+    'PostMasterService.ship_train': lambda context: context.post_master_service.ship_train(*context.ship_target) if context.ship_target else None,
+    'PostMasterService.get_train_status': lambda context: context.post_master_service.get_train_status(context.shipment.train_id if context.shipment else context.open_trains[0].id),
+    'PostMasterService.get_train_statuses': lambda context: context.post_master_service.get_train_statuses(context.train_ids),
+    'PostMasterService.schedule_shipments': lambda context: context.post_master_service.schedule_shipments(dry_run=True),
+    'PostMasterService.get_inconsistent_shipments': lambda context: context.post_master_service.get_inconsistent_shipments(),
+    'OptimizerService.minimize_cost': lambda context: context.optimizer_service.minimize_cost(context.lines, context.open_trains, context.get_parcels()),
+    'OptimizerService.minimize_cost_timetable': lambda context: context.optimizer_service.minimize_cost_timetable(context.lines, context.open_trains, context.get_parcels()),
+    'OptimizerService.minimize_cost_assignment': lambda context: context.optimizer_service.minimize_cost_assignment(context.lines, context.open_trains, context.get_parcels()),
+}
+
+def get_cases(names=None):
+    # any case whose name contains one of the given names, e.g. "ParcelService" or "ship_train"
+    if not names:
+        return dict(CASES)
+    return { name: case for name, case in CASES.items() if any([selected in name for selected in names]) }
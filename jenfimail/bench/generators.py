@@ -0,0 +1,69 @@
+from django.db import transaction
+
+import numpy as np
+
+from ..models import Line, Train, TrainLine
+from ..services import solve_cache
+
+class BenchDataGenerator():
+    """ Seeded synthetic lines, trains and parcels; the same seed gives the same data. """
+
+    def __init__(self, **args):
+        self.seed = int(args.get('seed', 42))
+        self.chunk_size = int(args.get('chunk_size', 5000))
+        self.prefix = args.get('prefix', 'bench-{}'.format(self.seed))
+        self.rng = np.random.default_rng(self.seed)
+
+    @transaction.atomic
+    def create_lines(self, no_of_lines):
+        names = ['{}-line-{}'.format(self.prefix, i) for i in range(no_of_lines)]
+        Line.objects.bulk_create([Line(name=name) for name in names], ignore_conflicts=True)
+        return list(Line.objects.filter(name__in=names).order_by('id'))
+
+    def train_data(self, no_of_trains, lines):
+        # most trains carry a few hundred kg, a few are much bigger; volume follows at 2-8 units per kg
+        weight_capacities = np.clip(self.rng.lognormal(np.log(400), 0.6, no_of_trains), 50, 5000).round(0)
+        volume_capacities = (weight_capacities * self.rng.uniform(2, 8, no_of_trains)).round(0)
+        # bigger trains cost more, but not proportionally
+        costs = (np.sqrt(weight_capacities) * self.rng.uniform(5, 15, no_of_trains)).round(2)
+        line_counts = self.rng.integers(1, min(3, len(lines)) + 1, no_of_trains)
+
+        return [{
+            'name': '{}-train-{}'.format(self.prefix, i),
+            'cost': float(costs[i]),
+            'weight_capacity': float(weight_capacities[i]),
+            'volume_capacity': float(volume_capacities[i]),
+            'lines': [lines[j] for j in self.rng.choice(len(lines), line_counts[i], replace=False)],
+        } for i in range(no_of_trains)]
+
+    @transaction.atomic
+    def create_trains(self, no_of_trains, lines):
+        data = self.train_data(no_of_trains, lines)
+        trains = Train.objects.bulk_create([
+            Train(name=train['name'], cost=train['cost'], weight_capacity=train['weight_capacity'], volume_capacity=train['volume_capacity'])
+            for train in data
+        ], batch_size=self.chunk_size)
+        TrainLine.objects.bulk_create([
+            TrainLine(train=train, line=line) for train, entry in zip(trains, data) for line in entry['lines']
+        ], batch_size=self.chunk_size)
+        solve_cache.invalidate()
+        return trains
+
+    def parcel_data(self, no_of_parcels, offset=0):
+        # long tailed weights, mostly letters and small boxes, with the density varying per parcel
+        weights = np.clip(self.rng.lognormal(np.log(3), 1.0, no_of_parcels), 0.1, 200).round(2)
+        volumes = np.clip(weights * self.rng.lognormal(np.log(6), 0.5, no_of_parcels), 0.5, 1000).round(2)
+
+        return [{
+            'label': '{}-parcel-{}'.format(self.prefix, offset + i),
+            'weight': float(weights[i]),
+            'volume': float(volumes[i]),
+            'description': '',
+        } for i in range(no_of_parcels)]
+
+    def create_parcels(self, no_of_parcels, parcel_service):
+        # through the service, so the backlog summary follows
+        parcels = 0
+        for offset in range(0, no_of_parcels, self.chunk_size):
+            parcels += len(parcel_service.deposit_parcels(self.parcel_data(min(self.chunk_size, no_of_parcels - offset), offset=offset)))
+        return parcels
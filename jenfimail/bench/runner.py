@@ -0,0 +1,83 @@
+from django.db import connection, transaction
+
+import time
+import tracemalloc
+
+import numpy as np
+
+from ..instrumentation import QueryCounter
+from ..services import solve_cache, status_cache, line_availability_index
+from ..services.optimizer import OptimizationResult
+
+class BenchmarkRunner():
+    """ Times one case over a number of runs, each inside a transaction that is rolled back. """
+
+    def __init__(self, **args):
+        self.repeat = int(args.get('repeat', 5))
+        self.warmup = int(args.get('warmup', 1))
+        self.track_memory = bool(args.get('track_memory', True))
+
+    def run(self, name, case, context):
+        samples = []
+        for i in range(self.warmup + self.repeat):
+            sample = self.measure(case, context)
+            if i >= self.warmup:
+                samples.append(sample)
+
+        wall_times = np.array([sample['wall_time'] for sample in samples]) * 1000
+        result = {
+            'name': name,
+            'repeat': len(samples),
+            'wall_ms': {
+                'min': float(wall_times.min()),
+                'median': float(np.median(wall_times)),
+                'mean': float(wall_times.mean()),
+                'p95': float(np.percentile(wall_times, 95)),
+                'max': float(wall_times.max()),
+            },
+            'queries': int(np.median([sample['queries'] for sample in samples])),
+            'query_ms': float(np.median([sample['query_time'] for sample in samples]) * 1000),
+            'solver_ms': None,
+            'peak_memory_kb': None,
+        }
+
+        solver_times = [sample['solver_time'] for sample in samples if sample['solver_time'] is not None]
+        if solver_times:
+            result['solver_ms'] = float(np.median(solver_times) * 1000)
+
+        # tracemalloc slows everything down, so memory gets a run of its own
+        if self.track_memory:
+            tracemalloc.start()
+            try:
+                self.measure(case, context)
+                result['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+            finally:
+                tracemalloc.stop()
+
+        return result
+
+    def measure(self, case, context):
+        counter = QueryCounter()
+        self.reset_caches()
+        try:
+            with transaction.atomic(), connection.execute_wrapper(counter):
+                started_at = time.perf_counter()
+                value = case(context)
+                wall_time = time.perf_counter() - started_at
+                # every run starts from the same data
+                transaction.set_rollback(True)
+        finally:
+            # in-process caches do not roll back with the database
+            self.reset_caches()
+
+        return {
+            'wall_time': wall_time,
+            'queries': counter.count,
+            'query_time': counter.time,
+            'solver_time': value.wall_time if isinstance(value, OptimizationResult) else None,
+        }
+
+    def reset_caches(self):
+        solve_cache.reset()
+        status_cache.clear()
+        line_availability_index.invalidate()
@@ -27,3 +27,28 @@ class ParcelNotPendingException(Exception):
     def __init__(self):
         self.message = 'unable to withdraw parcel not in pending state'
         super().__init__(self.message)
+
+class PackingStrategyNotValidException(Exception):
+    def __init__(self):
+        self.message = 'packing strategy not valid'
+        super().__init__(self.message)
+
+class SolverNotValidException(Exception):
+    def __init__(self):
+        self.message = 'solver not valid'
+        super().__init__(self.message)
+
+class SolverNotAvailableException(Exception):
+    def __init__(self):
+        self.message = 'solver not available'
+        super().__init__(self.message)
+
+class SolverOptionNotSupportedException(Exception):
+    def __init__(self, option, solver):
+        self.message = '{} is not supported by the {} solver'.format(option, solver)
+        super().__init__(self.message)
+
+class StatusIdsNotValidException(Exception):
+    def __init__(self):
+        self.message = 'ids must be a non-empty list of integers within the batch size limit'
+        super().__init__(self.message)
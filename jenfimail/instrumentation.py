@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.db import connection
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+import bisect
+import functools
+import inspect
+import json
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger('jenfimail.instrumentation')
+
+# calls open in the current request or task, outermost first
+_frames = ContextVar('jenfimail_instrumentation_frames', default=())
+
+class QueryCounter():
+    """ connection.execute_wrapper hook counting the queries and the time spent in them. """
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.time += time.perf_counter() - started_at
+
+class Frame():
+    def __init__(self, kind, name, sampled):
+        self.kind = kind
+        self.name = name
+        self.sampled = sampled
+        self.status = 'ok'
+        self.wall_time = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        self.solver_time = 0.0
+
+class MetricsRegistry():
+    """ Per-process call metrics, rendered in the Prometheus text format. """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {}
+            self.durations = {}
+            self.sampled = {}
+
+    def observe(self, frame):
+        key = (frame.kind, frame.name)
+        calls_key = key + (frame.status,)
+        # le buckets are cumulated when rendering, a call only lands in its own one here
+        bucket = bisect.bisect_left(self.BUCKETS, frame.wall_time)
+        with self.lock:
+            self.calls[calls_key] = self.calls.get(calls_key, 0) + 1
+
+            # [per bucket counts..., +Inf, sum, count]
+            duration = self.durations.get(key)
+            if duration is None:
+                duration = self.durations[key] = [0] * (len(self.BUCKETS) + 1) + [0.0, 0]
+            duration[bucket] += 1
+            duration[-2] += frame.wall_time
+            duration[-1] += 1
+
+            # queries and solver time are only measured on sampled calls
+            if frame.sampled:
+                sampled = self.sampled.setdefault(key, [0, 0, 0.0, 0.0])
+                sampled[0] += 1
+                sampled[1] += frame.queries
+                sampled[2] += frame.query_time
+                sampled[3] += frame.solver_time
+
+    def render(self):
+        with self.lock:
+            calls, durations, sampled = dict(self.calls), { key: list(value) for key, value in self.durations.items() }, { key: list(value) for key, value in self.sampled.items() }
+
+        lines = [
+            '# HELP jenfimail_calls_total Instrumented requests and service calls.',
+            '# TYPE jenfimail_calls_total counter',
+        ]
+        for (kind, name, status), count in sorted(calls.items()):
+            lines.append('jenfimail_calls_total{{{labels},status="{status}"}} {count}'.format(labels=self.labels(kind, name), status=status, count=count))
+
+        lines += [
+            '# HELP jenfimail_call_duration_seconds Wall time of instrumented calls.',
+            '# TYPE jenfimail_call_duration_seconds histogram',
+        ]
+        for (kind, name), duration in sorted(durations.items()):
+            labels = self.labels(kind, name)
+            count = 0
+            for bound, bucket_count in zip(self.BUCKETS, duration):
+                count += bucket_count
+                lines.append('jenfimail_call_duration_seconds_bucket{{{labels},le="{bound}"}} {count}'.format(labels=labels, bound=bound, count=count))
+            lines.append('jenfimail_call_duration_seconds_bucket{{{labels},le="+Inf"}} {count}'.format(labels=labels, count=duration[-1]))
+            lines.append('jenfimail_call_duration_seconds_sum{{{labels}}} {value}'.format(labels=labels, value=duration[-2]))
+            lines.append('jenfimail_call_duration_seconds_count{{{labels}}} {count}'.format(labels=labels, count=duration[-1]))
+
+        for index, metric, kind_of, help_text in [
+            (0, 'jenfimail_sampled_calls_total', 'counter', 'Calls whose queries and solver time were measured.'),
+            (1, 'jenfimail_db_queries_total', 'counter', 'Database queries of sampled calls.'),
+            (2, 'jenfimail_db_query_seconds_total', 'counter', 'Database time of sampled calls.'),
+            (3, 'jenfimail_solver_seconds_total', 'counter', 'Solver time of sampled calls.'),
+        ]:
+            lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} {}'.format(metric, kind_of)]
+            for (kind, name), values in sorted(sampled.items()):
+                lines.append('{metric}{{{labels}}} {value}'.format(metric=metric, labels=self.labels(kind, name), value=values[index]))
+
+        return '\n'.join(lines) + '\n'
+
+    def labels(self, kind, name):
+        return 'kind="{}",name="{}"'.format(kind, name.replace('\\', '\\\\').replace('"', '\\"'))
+
+class Instrumentation():
+    """ Times requests and service calls; a sampled share also counts queries and solver time and is logged as JSON. """
+
+    KIND_REQUEST = 'request'
+    KIND_SERVICE = 'service'
+
+    def __init__(self, **args):
+        self.enabled = bool(args.get('enabled', True))
+        self.sample_rate = float(args.get('sample_rate', 0.01))
+        self.registry = args.get('registry') or MetricsRegistry()
+
+    @contextmanager
+    def track(self, kind, name):
+        if not self.enabled:
+            yield None
+            return
+
+        frames = _frames.get()
+        # nested calls follow the sampling decision of the outermost one
+        sampled = frames[0].sampled if frames else random.random() < self.sample_rate
+        frame = Frame(kind, name, sampled)
+        token = _frames.set(frames + (frame,))
+
+        # one wrapper per connection, every open frame is credited from it
+        wrapped = sampled and self.count_query not in connection.execute_wrappers
+        started_at = time.perf_counter()
+        try:
+            if wrapped:
+                with connection.execute_wrapper(self.count_query):
+                    yield frame
+            else:
+                yield frame
+        except BaseException:
+            frame.status = 'error'
+            raise
+        finally:
+            frame.wall_time = time.perf_counter() - started_at
+            _frames.reset(token)
+            self.registry.observe(frame)
+            if sampled:
+                self.log(frame)
+
+    def count_query(self, execute, sql, params, many, context):
+        started_at = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            for frame in _frames.get():
+                frame.queries += 1
+                frame.query_time += elapsed
+
+    def record_solver_time(self, seconds):
+        for frame in _frames.get():
+            frame.solver_time += seconds
+
+    def log(self, frame):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info(json.dumps({
+            'event': 'call',
+            'kind': frame.kind,
+            'name': frame.name,
+            'status': frame.status,
+            'wall_ms': round(frame.wall_time * 1000, 3),
+            'queries': frame.queries,
+            'query_ms': round(frame.query_time * 1000, 3),
+            'solver_ms': round(frame.solver_time * 1000, 3),
+        }))
+
+instrumentation = Instrumentation(
+    enabled=getattr(settings, 'INSTRUMENTATION_ENABLED', True),
+    sample_rate=getattr(settings, 'INSTRUMENTATION_SAMPLE_RATE', 0.01)
+)
+
+def instrument(name):
+    def decorator(method):
+        if inspect.iscoroutinefunction(method):
+            @functools.wraps(method)
+            async def async_wrapper(*args, **kwargs):
+                # async ORM calls run on another thread's connection, so only the wall time is measured here
+                with instrumentation.track(Instrumentation.KIND_SERVICE, name):
+                    return await method(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            with instrumentation.track(Instrumentation.KIND_SERVICE, name):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def uninstrumented(method):
+    # for methods returning a lazy queryset, its queries run after the call and would be credited to the caller
+    method.uninstrumented = True
+    return method
+
+def instrumented(cls):
+    # wraps every public method the class defines itself, named Class.method
+    for attr, method in list(vars(cls).items()):
+        if not attr.startswith('_') and inspect.isfunction(method) and not getattr(method, 'uninstrumented', False):
+            setattr(cls, attr, instrument('{}.{}'.format(cls.__name__, attr))(method))
+    return cls
+
+def solver_timed(method):
+    # the method's own wall time counts as solver time of every call it runs under
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            instrumentation.record_solver_time(time.perf_counter() - started_at)
+    return wrapper
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand
+
+from datetime import datetime, timedelta, timezone
+
+from ...services import ArchiveService
+
+class Command(BaseCommand):
+    help = 'Moves parcels of arrived shipments and withdrawn parcels to the archive tables in batches; safe to stop and rerun'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=float, default=0, help='only archive shipments that arrived, and parcels withdrawn, this long ago')
+        parser.add_argument('--shipments-per-batch', type=int, default=10)
+        parser.add_argument('--parcels-per-batch', type=int, default=1000, help='withdrawn parcels per batch')
+        parser.add_argument('--max-batches', type=int, default=None, help='stop after this many batches, the next run resumes')
+        parser.add_argument('--dry-run', action='store_true', help='only count what would be archived')
+
+    def handle(self, *args, **options):
+        archive_service = ArchiveService(
+            shipments_per_batch=options['shipments_per_batch'],
+            parcels_per_batch=options['parcels_per_batch']
+        )
+        before = datetime.now(timezone.utc) - timedelta(days=options['older_than_days'])
+
+        if options['dry_run']:
+            self.stdout.write('{shipments} shipment(s) and {withdrawals} withdrawn parcel(s) to archive'.format(
+                shipments=archive_service.get_archivable_shipments(before).count(),
+                withdrawals=archive_service.get_archivable_withdrawals(before).count(),
+            ))
+            return
+
+        totals = { ArchiveService.KIND_SHIPMENTS: 0, ArchiveService.KIND_WITHDRAWALS: 0 }
+        archived = 0
+        for kind, count, parcels in archive_service.archive(before, max_batches=options['max_batches']):
+            totals[kind] += count
+            archived += parcels
+            self.stdout.write('archived {count} {kind}, {parcels} parcel(s)'.format(count=count, kind=kind, parcels=parcels))
+
+        self.stdout.write(self.style.SUCCESS('archived {parcels} parcel(s) from {shipments} shipment(s) and {withdrawals} withdrawal(s)'.format(
+            parcels=archived,
+            shipments=totals[ArchiveService.KIND_SHIPMENTS],
+            withdrawals=totals[ArchiveService.KIND_WITHDRAWALS],
+        )))
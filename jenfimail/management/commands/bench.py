@@ -0,0 +1,107 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+import django
+
+from datetime import datetime, timezone
+import json
+import platform
+import subprocess
+import time
+
+from ...bench import BenchDataGenerator, BenchmarkRunner, BenchContext, get_cases
+from ...services import ParcelService, OptimizerService
+
+class Command(BaseCommand):
+    help = 'Seeds synthetic lines, trains and parcels and times every service method, printing the results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--parcels', type=int, default=10000)
+        parser.add_argument('--trains', type=int, default=50)
+        parser.add_argument('--lines', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--repeat', type=int, default=5, help='timed runs per case')
+        parser.add_argument('--warmup', type=int, default=1, help='untimed runs per case first')
+        parser.add_argument('--case', action='append', help='only cases whose name contains this, repeatable')
+        parser.add_argument('--solver', default=OptimizerService.SOLVER_CBC, choices=OptimizerService.SOLVERS)
+        parser.add_argument('--time-limit', type=int, default=None, help='solver time limit in seconds')
+        parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run per case')
+        parser.add_argument('--current-db', action='store_true', help='seed the configured database instead of a throwaway test database')
+        parser.add_argument('--output', help='write the JSON here instead of stdout')
+        parser.add_argument('--compare', help='JSON of an earlier run to print median changes against')
+
+    def handle(self, *args, **options):
+        cases = get_cases(options['case'])
+        if not cases:
+            raise CommandError('no case matches {}'.format(options['case']))
+
+        old_name = None
+        if not options['current_db']:
+            # the same engine as configured, on a database of its own
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            report = self.run(cases, options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+
+        if options['compare']:
+            with open(options['compare']) as file:
+                self.compare(json.load(file), report)
+
+    def run(self, cases, options):
+        generator = BenchDataGenerator(seed=options['seed'])
+
+        started_at = time.perf_counter()
+        lines = generator.create_lines(options['lines'])
+        generator.create_trains(options['trains'], lines)
+        generator.create_parcels(options['parcels'], ParcelService())
+        context = BenchContext(generator, solver=options['solver'], time_limit=options['time_limit']).prepare()
+        seed_secs = time.perf_counter() - started_at
+
+        runner = BenchmarkRunner(repeat=options['repeat'], warmup=options['warmup'], track_memory=not options['no_memory'])
+        results = []
+        for name, case in cases.items():
+            self.stderr.write(name)
+            results.append(runner.run(name, case, context))
+
+        return {
+            'meta': {
+                'commit': self.get_commit(),
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'vendor': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'seed': options['seed'],
+                'parcels': options['parcels'],
+                'trains': options['trains'],
+                'lines': options['lines'],
+                'solver': options['solver'],
+                'repeat': options['repeat'],
+                'seed_secs': seed_secs,
+            },
+            'results': results,
+        }
+
+    def get_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def compare(self, baseline, report):
+        medians = { result['name']: result['wall_ms']['median'] for result in baseline.get('results', []) }
+        for result in report['results']:
+            before = medians.get(result['name'])
+            if not before:
+                continue
+            after = result['wall_ms']['median']
+            self.stderr.write('{name:50} {before:10.2f} ms -> {after:10.2f} ms  {change:+7.1f}%'.format(
+                name=result['name'], before=before, after=after, change=(after / before - 1) * 100
+            ))
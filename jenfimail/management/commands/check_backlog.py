@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+
+import math
+
+from ...services import BacklogService
+
+class Command(BaseCommand):
+    help = 'Compares the pending backlog summary against the parcels, optionally rebuilding the summary and histogram'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='rebuild the summary and histogram from the pending parcels')
+
+    def handle(self, *args, **options):
+        backlog = BacklogService()
+        stored, counted = backlog.get_drift()
+
+        if stored is None:
+            self.stdout.write('no backlog summary stored')
+        else:
+            self.stdout.write('count {stored_count}/{count} weight {stored_weight}/{weight} volume {stored_volume}/{volume}'.format(
+                stored_count=stored[0],
+                count=counted[0],
+                stored_weight=stored[1],
+                weight=counted[1],
+                stored_volume=stored[2],
+                volume=counted[2],
+            ))
+
+        consistent = stored is not None and stored[0] == counted[0] and all([math.isclose(a, b, abs_tol=1e-6) for a, b in zip(stored[1:], counted[1:])])
+        if consistent and not options['fix']:
+            self.stdout.write(self.style.SUCCESS('backlog summary is consistent'))
+            return
+
+        if options['fix']:
+            summary = backlog.rebuild()
+            self.stdout.write(self.style.SUCCESS('rebuilt the backlog summary: {count} pending parcel(s)'.format(count=summary.count)))
+        else:
+            self.stdout.write(self.style.WARNING('backlog summary is out of step, rerun with --fix to rebuild it'))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService
+
+class Command(BaseCommand):
+    help = 'Compares the stored shipment totals against their parcels, optionally repairing them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='rewrite the totals of inconsistent shipments')
+
+    def handle(self, *args, **options):
+        post_master_service = PostMasterService(TrainOperatorService(), ParcelService(), OptimizerService())
+        shipments = post_master_service.get_inconsistent_shipments()
+
+        for shipment in shipments:
+            self.stdout.write('shipment {id}: weight {total_weight}/{weight} volume {total_volume}/{volume} revenue {total_revenue}/{revenue}'.format(
+                id=shipment.id,
+                total_weight=shipment.total_weight,
+                weight=shipment.parcels_weight,
+                total_volume=shipment.total_volume,
+                volume=shipment.parcels_volume,
+                total_revenue=shipment.total_revenue,
+                revenue=shipment.parcels_revenue,
+            ))
+
+        if not shipments:
+            self.stdout.write(self.style.SUCCESS('all shipment totals are consistent'))
+            return
+
+        if options['fix']:
+            post_master_service.fix_shipment_totals(shipments)
+            self.stdout.write(self.style.SUCCESS('fixed {count} shipment(s)'.format(count=len(shipments))))
+        else:
+            self.stdout.write(self.style.WARNING('{count} inconsistent shipment(s), rerun with --fix to repair'.format(count=len(shipments))))
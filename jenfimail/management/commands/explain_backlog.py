@@ -0,0 +1,156 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+import json
+
+from ...models import Line, Train, Parcel, Shipment
+from ...services import ParcelService, PackerService, BacklogService
+
+BACKLOG_INDEX = 'jenfimail_parcel_backlog_idx'
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = 'EXPLAIN ANALYZEs the backlog queries on PostgreSQL with and without the partial backlog index, optionally seeding a parcel history first'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-rows', type=int, default=0, help='parcels to seed first, e.g. 5000000; use a scratch database')
+        parser.add_argument('--pending', type=int, default=20000, help='how many of the seeded parcels are still pending')
+        parser.add_argument('--withdrawn-ratio', type=float, default=0.05, help='share of the seeded history that was withdrawn rather than shipped')
+        parser.add_argument('--parcels-per-shipment', type=int, default=1000)
+        parser.add_argument('--seed', type=float, default=0.42, help='postgres setseed() value, between -1 and 1')
+        parser.add_argument('--capacity', default='100,500', help='weight,volume of the train being filled')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('needs PostgreSQL, partial index plans differ elsewhere')
+
+        if options['seed_rows']:
+            self.seed(options)
+
+        capacity = tuple(float(value) for value in options['capacity'].split(','))
+        queries = self.get_queries(capacity)
+
+        results = { 'capacity': capacity, 'queries': {} }
+        for name, queryset in queries.items():
+            results['queries'][name] = { 'with_index': self.explain(queryset) }
+
+        # DDL is transactional in postgres, the index is only gone inside this block
+        try:
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute('DROP INDEX {}'.format(connection.ops.quote_name(BACKLOG_INDEX)))
+                for name, queryset in queries.items():
+                    results['queries'][name]['without_index'] = self.explain(queryset)
+                raise Rollback()
+        except Rollback:
+            pass
+
+        self.stdout.write(json.dumps(results, indent=2))
+
+    def get_queries(self, capacity):
+        parcel_service = ParcelService()
+        within_capacity = parcel_service.get_parcels_within_capacity(capacity)
+        return {
+            # PackerService.load_candidates
+            'pack candidates': within_capacity.only(*PackerService.CANDIDATE_FIELDS).order_by('created_at', 'id'),
+            # ParcelService.is_fillable
+            'is fillable': within_capacity.order_by('created_at')[:1],
+            # the rows OptimizerService.get_parcel_load sums up
+            'parcel load': within_capacity.order_by().values_list('weight', 'volume'),
+        }
+
+    def explain(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+        plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+
+        nodes = []
+        self.walk(plan['Plan'], nodes)
+        return {
+            'execution_ms': plan['Execution Time'],
+            'planning_ms': plan['Planning Time'],
+            'shared_hit_blocks': plan['Plan'].get('Shared Hit Blocks'),
+            'shared_read_blocks': plan['Plan'].get('Shared Read Blocks'),
+            'heap_fetches': sum([node.get('heap_fetches') or 0 for node in nodes]),
+            'nodes': nodes,
+        }
+
+    def walk(self, node, nodes):
+        nodes.append({
+            'type': node['Node Type'],
+            'index': node.get('Index Name'),
+            'rows': node.get('Actual Rows'),
+            'heap_fetches': node.get('Heap Fetches'),
+        })
+        for child in node.get('Plans', []):
+            self.walk(child, nodes)
+
+    def seed(self, options):
+        rows, pending = options['seed_rows'], min(options['pending'], options['seed_rows'])
+        shipments = max(1, (rows - pending) // options['parcels_per_shipment'])
+        tables = {
+            'line': Line._meta.db_table,
+            'train': Train._meta.db_table,
+            'shipment': Shipment._meta.db_table,
+            'parcel': Parcel._meta.db_table,
+        }
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT setseed(%s)', [options['seed']])
+            cursor.execute(
+                "INSERT INTO {line} (name, description) VALUES ('bench', NULL) ON CONFLICT (name) DO UPDATE SET name = EXCLUDED.name RETURNING id".format(**tables)
+            )
+            line_id = cursor.fetchone()[0]
+
+            # one booked train per historical shipment, all arrived long ago
+            cursor.execute(
+                '''
+                WITH trains AS (
+                    INSERT INTO {train} (name, cost, weight_capacity, volume_capacity, status)
+                    SELECT 'bench-' || g, 100, 100000, 500000, 'booked' FROM generate_series(1, %s) g
+                    RETURNING id
+                )
+                INSERT INTO {shipment} (train_id, line_id, departure_date, arrival_date, total_weight, total_volume, total_revenue)
+                SELECT id, %s, now() - interval '400 days', now() - interval '399 days', 0, 0, 0 FROM trains
+                RETURNING id
+                '''.format(**tables),
+                [shipments, line_id]
+            )
+            shipment_ids = [row[0] for row in cursor.fetchall()]
+
+            # the oldest rows are history, the newest `pending` rows are the live backlog
+            cursor.execute(
+                '''
+                INSERT INTO {parcel} (label, weight, volume, cost, description, created_at, withdrawn_at, shipment_id)
+                SELECT
+                    'bench-' || g,
+                    round((1 + random() * 99)::numeric, 2),
+                    round((1 + random() * 499)::numeric, 2),
+                    NULL,
+                    '',
+                    now() - (%(rows)s - g) * interval '5 seconds',
+                    CASE WHEN g <= %(history)s AND r < %(withdrawn_ratio)s THEN now() - (%(rows)s - g) * interval '5 seconds' + interval '1 hour' END,
+                    CASE WHEN g <= %(history)s AND r >= %(withdrawn_ratio)s THEN (%(shipment_ids)s::bigint[])[1 + g %% %(shipments)s] END
+                FROM (SELECT g, random() AS r FROM generate_series(1, %(rows)s) g) seeded
+                '''.format(**tables),
+                {
+                    'rows': rows,
+                    'history': rows - pending,
+                    'withdrawn_ratio': options['withdrawn_ratio'],
+                    'shipment_ids': shipment_ids,
+                    'shipments': len(shipment_ids),
+                }
+            )
+
+        # sets the visibility map too, without it postgres cannot answer from the index alone
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE {parcel}'.format(**tables))
+
+        # the raw inserts bypassed the services, count the summary again
+        BacklogService().rebuild()
+
+        self.stderr.write('seeded {rows} parcels ({pending} pending) over {shipments} shipments'.format(rows=rows, pending=pending, shipments=len(shipment_ids)))
@@ -0,0 +1,91 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+import numpy as np
+import requests
+
+from ...models import Train, Parcel
+
+# the same reads, through the sync DRF views and through their async counterparts
+SYNC_PATHS = {
+    'parcel status': '/api/parcels/{parcel_id}/status/',
+    'train status': '/api/trains/{train_id}/status/',
+    'trains': '/trains/?limit=100',
+    'parcels': '/parcels/?limit=100',
+}
+ASYNC_PATHS = {
+    'parcel status': '/api/async/parcels/{parcel_id}/status/',
+    'train status': '/api/async/trains/{train_id}/status/',
+    'trains': '/async/trains/?limit=100',
+    'parcels': '/async/parcels/?limit=100',
+}
+
+class Command(BaseCommand):
+    help = 'Load tests the read endpoints of a running WSGI and/or ASGI server and reports requests/sec and latency percentiles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi', help='base url of a WSGI server, e.g. http://127.0.0.1:8000 (gunicorn jenfiexam.wsgi)')
+        parser.add_argument('--asgi', help='base url of an ASGI server, e.g. http://127.0.0.1:8001 (uvicorn jenfiexam.asgi:application)')
+        parser.add_argument('--requests', type=int, default=2000, help='requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=32, help='concurrent clients')
+        parser.add_argument('--parcel-id', type=int, help='parcel to poll, defaults to the latest one')
+        parser.add_argument('--train-id', type=int, help='train to poll, defaults to the latest one')
+        parser.add_argument('--json', action='store_true', help='print the results as json')
+
+    def handle(self, *args, **options):
+        targets = [(name, options[name], paths) for name, paths in [('wsgi', SYNC_PATHS), ('asgi', ASYNC_PATHS)] if options[name]]
+        if not targets:
+            raise CommandError('pass --wsgi and/or --asgi')
+
+        ids = {
+            'parcel_id': options['parcel_id'] or Parcel.objects.values_list('id', flat=True).order_by('-id').first(),
+            'train_id': options['train_id'] or Train.objects.values_list('id', flat=True).order_by('-id').first(),
+        }
+        if not ids['parcel_id'] or not ids['train_id']:
+            raise CommandError('needs at least one parcel and one train, or --parcel-id and --train-id')
+
+        results = []
+        for name, base_url, paths in targets:
+            for endpoint, path in paths.items():
+                url = base_url.rstrip('/') + path.format(**ids)
+                result = self.run(url, options['requests'], options['concurrency'])
+                result.update({ 'server': name, 'endpoint': endpoint, 'url': url })
+                results.append(result)
+                if not options['json']:
+                    self.stdout.write('{server:5} {endpoint:14} {rps:10.1f} req/s  p50 {p50:8.2f} ms  p99 {p99:8.2f} ms  errors {errors}'.format(**result))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+
+    def run(self, url, no_of_requests, concurrency):
+        # one keep-alive session per client thread
+        local = threading.local()
+
+        def fetch(_):
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            started_at = time.perf_counter()
+            try:
+                ok = local.session.get(url).ok
+            except requests.RequestException:
+                ok = False
+            return time.perf_counter() - started_at, ok
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(fetch, range(no_of_requests)))
+        wall_time = time.perf_counter() - started_at
+
+        latencies = np.array([latency for latency, _ in samples]) * 1000
+        return {
+            'requests': no_of_requests,
+            'concurrency': concurrency,
+            'errors': len([ok for _, ok in samples if not ok]),
+            'rps': no_of_requests / wall_time,
+            'p50': float(np.percentile(latencies, 50)),
+            'p99': float(np.percentile(latencies, 99)),
+        }
@@ -0,0 +1,40 @@
+import asyncio
+
+from .instrumentation import Instrumentation, instrumentation
+
+class InstrumentationMiddleware():
+    """ Tracks every request under its url route, e.g. "GET api/parcels/<int:parcel_id>/status/". """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # how django 4.1 tells an async middleware instance apart, see MiddlewareMixin._async_check
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        with instrumentation.track(Instrumentation.KIND_REQUEST, request.method) as frame:
+            response = self.get_response(request)
+            self.name_frame(frame, request, response)
+        return response
+
+    async def __acall__(self, request):
+        with instrumentation.track(Instrumentation.KIND_REQUEST, request.method) as frame:
+            response = await self.get_response(request)
+            self.name_frame(frame, request, response)
+        return response
+
+    def name_frame(self, frame, request, response):
+        # the route is only known once the url resolved, raw paths would give one series per id
+        if frame is None:
+            return
+        match = getattr(request, 'resolver_match', None)
+        frame.name = '{} {}'.format(request.method, match.route if match else 'unmatched')
+        if response.status_code >= 500:
+            frame.status = 'error'
@@ -0,0 +1,49 @@
+# Generated by Django 4.1.4 on 2026-10-18 06:57
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_shipment_totals(apps, schema_editor):
+    Shipment = apps.get_model('jenfimail', 'Shipment')
+    shipments = Shipment.objects.annotate(
+        weight=Sum('parcels__weight'),
+        volume=Sum('parcels__volume'),
+        revenue=Sum('parcels__cost'),
+    )
+    batch = []
+    for shipment in shipments.iterator(chunk_size=1000):
+        shipment.total_weight = shipment.weight or 0
+        shipment.total_volume = shipment.volume or 0
+        shipment.total_revenue = shipment.revenue or 0
+        batch.append(shipment)
+        if len(batch) == 1000:
+            Shipment.objects.bulk_update(batch, ['total_weight', 'total_volume', 'total_revenue'])
+            batch = []
+    Shipment.objects.bulk_update(batch, ['total_weight', 'total_volume', 'total_revenue'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenfimail', '0011_shipment_optimized_cost_per_weight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='shipment',
+            name='total_revenue',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='total_volume',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='total_weight',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(backfill_shipment_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 06:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenfimail', '0012_shipment_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='parcel',
+            index=models.Index(fields=['created_at', 'id'], name='jenfimail_p_created_69c142_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.4 on 2026-10-18 07:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenfimail', '0013_parcel_jenfimail_p_created_69c142_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='parcel',
+            index=models.Index(condition=models.Q(('shipment__isnull', True), ('withdrawn_at__isnull', True)), fields=['created_at', 'id', 'weight', 'volume'], name='jenfimail_parcel_backlog_idx'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.1.4 on 2026-10-18 07:18
+
+from django.db import migrations, models
+from django.db.models import Count, Sum, Min
+
+import math
+
+# frozen copies of BacklogBucket.WEIGHT_BUCKET_SIZE / VOLUME_BUCKET_SIZE
+WEIGHT_BUCKET_SIZE = 10.0
+VOLUME_BUCKET_SIZE = 50.0
+
+
+def backfill_backlog_summary(apps, schema_editor):
+    Parcel = apps.get_model('jenfimail', 'Parcel')
+    BacklogSummary = apps.get_model('jenfimail', 'BacklogSummary')
+    BacklogBucket = apps.get_model('jenfimail', 'BacklogBucket')
+
+    pending = Parcel.objects.filter(shipment=None, withdrawn_at=None)
+    totals = pending.aggregate(count=Count('id'), total_weight=Sum('weight'), total_volume=Sum('volume'), min_weight=Min('weight'), min_volume=Min('volume'))
+    BacklogSummary.objects.create(
+        pk=1,
+        count=totals['count'],
+        total_weight=totals['total_weight'] or 0,
+        total_volume=totals['total_volume'] or 0,
+        min_weight=totals['min_weight'],
+        min_volume=totals['min_volume'],
+    )
+
+    buckets = {}
+    for weight, volume in pending.values_list('weight', 'volume').iterator(chunk_size=10000):
+        bucket = buckets.setdefault((math.floor(weight / WEIGHT_BUCKET_SIZE), math.floor(volume / VOLUME_BUCKET_SIZE)), [0, 0.0, 0.0])
+        bucket[0] += 1
+        bucket[1] += weight
+        bucket[2] += volume
+    BacklogBucket.objects.bulk_create([
+        BacklogBucket(weight_bucket=key[0], volume_bucket=key[1], count=count, total_weight=weight, total_volume=volume)
+        for key, (count, weight, volume) in buckets.items()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenfimail', '0014_parcel_backlog_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BacklogBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight_bucket', models.IntegerField()),
+                ('volume_bucket', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('total_weight', models.FloatField(default=0)),
+                ('total_volume', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='BacklogSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('count', models.IntegerField(default=0)),
+                ('total_weight', models.FloatField(default=0)),
+                ('total_volume', models.FloatField(default=0)),
+                ('min_weight', models.FloatField(null=True)),
+                ('min_volume', models.FloatField(null=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='backlogbucket',
+            constraint=models.UniqueConstraint(fields=('weight_bucket', 'volume_bucket'), name='jenfimail_backlog_bucket_unique'),
+        ),
+        migrations.RunPython(backfill_backlog_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 4.1.4 on 2026-10-18 07:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jenfimail', '0015_backlog_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedParcel',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('label', models.CharField(max_length=100)),
+                ('weight', models.FloatField()),
+                ('volume', models.FloatField()),
+                ('cost', models.FloatField(null=True)),
+                ('description', models.CharField(max_length=250)),
+                ('created_at', models.DateTimeField()),
+                ('withdrawn_at', models.DateTimeField(null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedShipmentParcel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='archived_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='parcel',
+            index=models.Index(condition=models.Q(('withdrawn_at__isnull', False)), fields=['id'], name='jenfimail_parcel_withdrawn_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedshipmentparcel',
+            name='parcel',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='jenfimail.archivedparcel'),
+        ),
+        migrations.AddField(
+            model_name='archivedshipmentparcel',
+            name='shipment',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='jenfimail.shipment'),
+        ),
+        migrations.AddField(
+            model_name='archivedparcel',
+            name='shipment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='+', to='jenfimail.shipment'),
+        ),
+        migrations.AddField(
+            model_name='shipment',
+            name='archived_parcels',
+            field=models.ManyToManyField(related_name='shipments', through='jenfimail.ArchivedShipmentParcel', to='jenfimail.archivedparcel'),
+        ),
+    ]
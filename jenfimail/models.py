@@ -106,17 +106,39 @@ class Parcel(models.Model):
     class Meta:
         ordering = ['created_at']
         indexes = [
-            models.Index(fields=['weight', 'volume', 'withdrawn_at'])
+            models.Index(fields=['weight', 'volume', 'withdrawn_at']),
+            models.Index(fields=['created_at', 'id']),
+            # only the live backlog, which the packer scans in FIFO order
+            models.Index(
+                fields=['created_at', 'id', 'weight', 'volume'],
+                condition=models.Q(shipment__isnull=True, withdrawn_at__isnull=True),
+                name='jenfimail_parcel_backlog_idx'
+            ),
+            # withdrawals waiting for the archive, small once it has run
+            models.Index(
+                fields=['id'],
+                condition=models.Q(withdrawn_at__isnull=False),
+                name='jenfimail_parcel_withdrawn_idx'
+            ),
         ]
 
 class Shipment(models.Model):
     train = models.OneToOneField(Train, on_delete=models.RESTRICT)
     parcels = models.ManyToManyField(Parcel, through='ShipmentParcel', related_name='shipments')
+    archived_parcels = models.ManyToManyField('ArchivedParcel', through='ArchivedShipmentParcel', related_name='shipments')
     departure_date = models.DateTimeField(null=True)
     arrival_date = models.DateTimeField(null=True)
     line = models.ForeignKey(Line, on_delete=models.RESTRICT)
     optimized_cost_per_weight = models.FloatField(null=True)
 
+    # running totals of the loaded parcels, kept in step by PostMasterService
+    total_weight = models.FloatField(default=0)
+    total_volume = models.FloatField(default=0)
+    total_revenue = models.FloatField(default=0)
+
+    # set once ArchiveService moved every parcel of the shipment out of the hot tables
+    archived_at = models.DateTimeField(null=True)
+
     STATUS_IN_TRANSIT = 'in transit'
     STATUS_ARRIVED  = 'arrived'
     @property
@@ -129,20 +151,73 @@ class Shipment(models.Model):
 
     @property
     def weight(self):
-        return self.parcels.all().aggregate(weight=models.Sum('weight'))['weight']
+        return self.total_weight
 
     @property
     def volume(self):
-        return self.parcels.all().aggregate(volume=models.Sum('volume'))['volume']
+        return self.total_volume
 
     @property
     def density(self):
-        return self.weight / self.volume
+        return self.total_weight / self.total_volume
 
     @property
     def revenue(self):
-        return self.parcels.all().aggregate(revenue=models.Sum('cost'))['revenue']
+        return self.total_revenue
 
 class ShipmentParcel(models.Model):
     shipment = models.ForeignKey(Shipment, on_delete=models.CASCADE)
     porcel = models.ForeignKey(Parcel, on_delete=models.CASCADE)
+
+# cold copy of a shipped or withdrawn parcel, keeping its original id
+class ArchivedParcel(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    label = models.CharField(max_length=100)
+    weight = models.FloatField()
+    volume = models.FloatField()
+    cost = models.FloatField(null=True)
+    description = models.CharField(max_length=250)
+    created_at = models.DateTimeField()
+    withdrawn_at = models.DateTimeField(null=True)
+    shipment = models.ForeignKey('Shipment', on_delete=models.RESTRICT, blank=True, null=True, related_name='+')
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    @property
+    def status(self):
+        # only withdrawals and parcels of arrived shipments get archived
+        return Parcel.STATUS_WITHDRAWN if self.withdrawn_at else Parcel.STATUS_SHIPPED
+
+    @property
+    def load(self):
+        return (self.weight, self.volume)
+
+    class Meta:
+        ordering = ['created_at']
+
+class ArchivedShipmentParcel(models.Model):
+    shipment = models.ForeignKey(Shipment, on_delete=models.CASCADE)
+    parcel = models.ForeignKey(ArchivedParcel, on_delete=models.CASCADE)
+
+# running totals of the pending backlog, a single row kept in step by BacklogService
+class BacklogSummary(models.Model):
+    count = models.IntegerField(default=0)
+    total_weight = models.FloatField(default=0)
+    total_volume = models.FloatField(default=0)
+    min_weight = models.FloatField(null=True)
+    min_volume = models.FloatField(null=True)
+
+# one cell of the pending backlog's (weight, volume) histogram
+class BacklogBucket(models.Model):
+    WEIGHT_BUCKET_SIZE = 10.0
+    VOLUME_BUCKET_SIZE = 50.0
+
+    weight_bucket = models.IntegerField()
+    volume_bucket = models.IntegerField()
+    count = models.IntegerField(default=0)
+    total_weight = models.FloatField(default=0)
+    total_volume = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['weight_bucket', 'volume_bucket'], name='jenfimail_backlog_bucket_unique'),
+        ]
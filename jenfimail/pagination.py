@@ -0,0 +1,99 @@
+import base64
+import json
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+class KeysetPagination():
+    """ Seeks past the last row of the previous page on the given ordering instead of counting an offset. """
+
+    page_size = 100
+    max_page_size = 1000
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+
+    def __init__(self, ordering):
+        self.ordering = ordering
+        self.request = None
+        self.next_position = None
+
+    def get_query_params(self, request):
+        # DRF requests carry query_params, the plain django requests of the async views only GET
+        return getattr(request, 'query_params', request.GET)
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(self.get_query_params(request).get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_page_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by(*self.ordering)
+        position = self.decode_cursor(queryset.model, self.get_query_params(request).get(self.cursor_query_param))
+        if position:
+            queryset = queryset.filter(self.after(position))
+
+        # one extra row tells whether there is a next page
+        return queryset[:page_size + 1], page_size
+
+    def set_page(self, page, page_size):
+        if len(page) > page_size:
+            page = page[:page_size]
+            self.next_position = [getattr(page[-1], field) for field in self.ordering]
+        else:
+            self.next_position = None
+
+        return page
+
+    def paginate_queryset(self, queryset, request):
+        queryset, page_size = self.get_page_queryset(queryset, request)
+        return self.set_page(list(queryset), page_size)
+
+    async def apaginate_queryset(self, queryset, request):
+        queryset, page_size = self.get_page_queryset(queryset, request)
+        return self.set_page([obj async for obj in queryset], page_size)
+
+    def after(self, position):
+        # (a, b) > (x, y)  <=>  a > x or (a = x and b > y)
+        condition = Q()
+        for i, field in enumerate(self.ordering):
+            ties = { self.ordering[j]: position[j] for j in range(i) }
+            condition |= Q(**ties, **{ field + '__gt': position[i] })
+        return condition
+
+    def encode_cursor(self, position):
+        values = [value.isoformat() if hasattr(value, 'isoformat') else value for value in position]
+        return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+    def decode_cursor(self, model, cursor):
+        if not cursor:
+            return None
+
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+            if len(values) != len(self.ordering):
+                raise ValueError()
+            return [model._meta.get_field(field).to_python(value) for field, value in zip(self.ordering, values)]
+        except Exception:
+            raise NotFound('invalid cursor')
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.next_position))
+
+    def get_paginated_data(self, data):
+        return {
+            'next': self.get_next_link(),
+            'results': data,
+        }
+
+    def get_paginated_response(self, data):
+        return Response(self.get_paginated_data(data))
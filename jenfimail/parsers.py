@@ -0,0 +1,27 @@
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+class NDJSONParser(BaseParser):
+    """ Newline delimited JSON, one object per line; the stream is decoded line by line. """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        reader = codecs.getreader(encoding)(stream)
+
+        items = []
+        for line_no, line in enumerate(reader, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                raise ParseError('NDJSON parse error on line {line_no} - {error}'.format(line_no=line_no, error=str(e)))
+
+        return items
@@ -1,24 +1,68 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
-from .models import Line, Train, Parcel, Shipment
+from .models import Line, Train, Parcel, Shipment, ArchivedParcel
+
+class DynamicFieldsModelSerializer(serializers.ModelSerializer):
+    """ Takes an optional `fields` list and only serializes those, e.g. from a `?fields=id,status` projection. """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
 
 class LineSerializer(serializers.ModelSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset
+
     class Meta:
         model = Line
         fields = ["id", "name", "description"]
 
-class TrainSerializer(serializers.ModelSerializer):
+class TrainSerializer(DynamicFieldsModelSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # lines are listed by id, the prefetch replaces one query per train
+        return queryset.prefetch_related('lines')
+
     class Meta:
         model = Train
         fields = ['id', 'name', 'cost', 'weight_capacity', 'volume_capacity', 'lines', 'status']
 
-class ParcelSerializer(serializers.ModelSerializer):
+class ParcelSerializer(DynamicFieldsModelSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # status reads the shipment's arrival_date, join it instead of fetching per parcel
+        return queryset.select_related('shipment')
+
     class Meta:
         model = Parcel
         fields = ['id', 'label', 'weight', 'volume', 'status', 'cost']
 
+class ArchivedParcelSerializer(DynamicFieldsModelSerializer):
+    @staticmethod
+    def setup_eager_loading(queryset):
+        # archived status does not need the shipment
+        return queryset
+
+    class Meta:
+        model = ArchivedParcel
+        fields = ['id', 'label', 'weight', 'volume', 'status', 'cost']
+
 class ShipmentSerializer(serializers.ModelSerializer):
     parcels = ParcelSerializer(read_only=True, many=True)
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.prefetch_related(ShipmentSerializer.get_parcels_prefetch())
+
+    @staticmethod
+    def get_parcels_prefetch():
+        return Prefetch('parcels', queryset=ParcelSerializer.setup_eager_loading(Parcel.objects.all()))
+
     class Meta:
         model = Shipment
         fields = ['id',  'train', 'line', 'parcels', 'weight', 'volume', 'status']
@@ -2,3 +2,11 @@ from .train_operator import TrainOperatorService
 from .post_master import PostMasterService
 from .parcel import ParcelService
 from .optimizer import OptimizerService
+from .optimizer_session import OptimizerSession
+from .packer import PackerService
+from .export import ExportService
+from .line_availability import LineAvailabilityIndex, line_availability_index
+from .solve_cache import SolveCache, solve_cache
+from .status_cache import StatusCache, LocalStatusCacheBackend, DjangoStatusCacheBackend, status_cache
+from .backlog import BacklogService
+from .archive import ArchiveService
@@ -0,0 +1,83 @@
+from django.db import transaction
+
+from datetime import datetime, timezone
+
+from ..models import Parcel, Shipment, ShipmentParcel, ArchivedParcel, ArchivedShipmentParcel
+
+class ArchiveService():
+    """ Moves parcels that can no longer change out of the hot parcel tables. """
+
+    KIND_SHIPMENTS = 'shipments'
+    KIND_WITHDRAWALS = 'withdrawals'
+
+    def __init__(self, **args):
+        self.shipments_per_batch = int(args.get('shipments_per_batch', 10))
+        self.parcels_per_batch = int(args.get('parcels_per_batch', 1000))
+        self.bulk_chunk_size = int(args.get('bulk_chunk_size', 1000))
+
+    def get_archivable_shipments(self, before):
+        return Shipment.objects.filter(archived_at=None, arrival_date__lt=before).order_by('id')
+
+    def get_archivable_withdrawals(self, before):
+        return Parcel.objects.filter(shipment=None, withdrawn_at__lt=before).order_by('id')
+
+    def archive(self, before, max_batches=None):
+        # every batch commits on its own and the next one is read back from the tables, so an interrupted run just starts again
+        batches = 0
+        for kind, get_ids, archive_batch in [
+            (self.KIND_SHIPMENTS, lambda: self.get_archivable_shipments(before).values_list('id', flat=True)[:self.shipments_per_batch], self.archive_shipments),
+            (self.KIND_WITHDRAWALS, lambda: self.get_archivable_withdrawals(before).values_list('id', flat=True)[:self.parcels_per_batch], self.archive_withdrawals),
+        ]:
+            while max_batches is None or batches < max_batches:
+                ids = list(get_ids())
+                if not ids:
+                    break
+
+                yield kind, len(ids), archive_batch(ids, before)
+                batches += 1
+
+    @transaction.atomic
+    def archive_shipments(self, shipment_ids, before):
+        shipments = list(Shipment.objects.select_for_update().filter(id__in=shipment_ids, archived_at=None, arrival_date__lt=before))
+        if not shipments:
+            return 0
+
+        utc_now = datetime.now(timezone.utc)
+        parcels = list(Parcel.objects.filter(shipment__in=shipments))
+        links = list(ShipmentParcel.objects.filter(shipment__in=shipments).values_list('shipment_id', 'porcel_id'))
+
+        ArchivedParcel.objects.bulk_create([self.to_archive(parcel, utc_now) for parcel in parcels], batch_size=self.bulk_chunk_size)
+        ArchivedShipmentParcel.objects.bulk_create(
+            [ArchivedShipmentParcel(shipment_id=shipment_id, parcel_id=parcel_id) for shipment_id, parcel_id in links],
+            batch_size=self.bulk_chunk_size
+        )
+        ShipmentParcel.objects.filter(shipment__in=shipments).delete()
+        Parcel.objects.filter(shipment__in=shipments).delete()
+
+        Shipment.objects.filter(id__in=[shipment.id for shipment in shipments]).update(archived_at=utc_now)
+        return len(parcels)
+
+    @transaction.atomic
+    def archive_withdrawals(self, parcel_ids, before):
+        parcels = list(Parcel.objects.select_for_update().filter(id__in=parcel_ids, shipment=None, withdrawn_at__lt=before))
+        if not parcels:
+            return 0
+
+        utc_now = datetime.now(timezone.utc)
+        ArchivedParcel.objects.bulk_create([self.to_archive(parcel, utc_now) for parcel in parcels], batch_size=self.bulk_chunk_size)
+        Parcel.objects.filter(id__in=[parcel.id for parcel in parcels]).delete()
+        return len(parcels)
+
+    def to_archive(self, parcel, archived_at):
+        return ArchivedParcel(
+            id=parcel.id,
+            label=parcel.label,
+            weight=parcel.weight,
+            volume=parcel.volume,
+            cost=parcel.cost,
+            description=parcel.description,
+            created_at=parcel.created_at,
+            withdrawn_at=parcel.withdrawn_at,
+            shipment_id=parcel.shipment_id,
+            archived_at=archived_at,
+        )
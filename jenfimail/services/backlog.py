@@ -0,0 +1,206 @@
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Count, Sum, Min, Value
+from django.db.models.functions import Least
+
+import math
+
+from ..models import Parcel, BacklogSummary, BacklogBucket
+
+class BacklogService():
+    """ Maintains the pending backlog summary and histogram so totals and fit checks skip scanning Parcel. """
+
+    SUMMARY_ID = 1
+
+    def bucket_of(self, weight, volume):
+        return (math.floor(weight / BacklogBucket.WEIGHT_BUCKET_SIZE), math.floor(volume / BacklogBucket.VOLUME_BUCKET_SIZE))
+
+    def get_pending_parcels(self):
+        return Parcel.objects.filter(shipment=None, withdrawn_at=None)
+
+    def get_summary(self):
+        summary = BacklogSummary.objects.filter(pk=self.SUMMARY_ID).first()
+        if summary is None:
+            return self.rebuild()
+
+        if summary.count > 0 and (summary.min_weight is None or summary.min_volume is None):
+            minimums = self.get_pending_parcels().aggregate(min_weight=Min('weight'), min_volume=Min('volume'))
+            summary.min_weight, summary.min_volume = minimums['min_weight'], minimums['min_volume']
+            BacklogSummary.objects.filter(pk=self.SUMMARY_ID, count__gt=0).update(min_weight=summary.min_weight, min_volume=summary.min_volume)
+        return summary
+
+    def get_load(self):
+        summary = self.get_summary()
+        return (summary.total_weight, summary.total_volume)
+
+    @transaction.atomic
+    def add(self, parcels):
+        buckets = self._group(parcels)
+        if not buckets:
+            return
+
+        min_weight = min([float(parcel.weight) for parcel in parcels])
+        min_volume = min([float(parcel.volume) for parcel in parcels])
+        updated = BacklogSummary.objects.filter(pk=self.SUMMARY_ID).update(
+            count=F('count') + sum([bucket[0] for bucket in buckets.values()]),
+            total_weight=F('total_weight') + sum([bucket[1] for bucket in buckets.values()]),
+            total_volume=F('total_volume') + sum([bucket[2] for bucket in buckets.values()]),
+            min_weight=self._lower_minimum('min_weight', min_weight),
+            min_volume=self._lower_minimum('min_volume', min_volume),
+        )
+        if not updated:
+            # never built, counting from the parcels covers these ones too
+            self.rebuild()
+            return
+
+        self._update_buckets(buckets, 1)
+
+    @transaction.atomic
+    def remove(self, parcels):
+        # call once the parcels have left the backlog
+        buckets = self._group(parcels)
+        if not buckets:
+            return
+
+        summary = BacklogSummary.objects.select_for_update().filter(pk=self.SUMMARY_ID).first()
+        if summary is None:
+            self.rebuild()
+            return
+
+        summary.count -= sum([bucket[0] for bucket in buckets.values()])
+        summary.total_weight -= sum([bucket[1] for bucket in buckets.values()])
+        summary.total_volume -= sum([bucket[2] for bucket in buckets.values()])
+        if summary.count <= 0:
+            # start from exact zeros again instead of carrying float drift
+            summary.count, summary.total_weight, summary.total_volume = 0, 0, 0
+            summary.min_weight, summary.min_volume = None, None
+        elif self._is_at_most(parcels, 'weight', summary.min_weight) or self._is_at_most(parcels, 'volume', summary.min_volume):
+            # the minimum left with these parcels, get_summary finds the new one when it is asked for
+            summary.min_weight, summary.min_volume = None, None
+        summary.save()
+
+        self._update_buckets(buckets, -1)
+
+    def has_parcels_within(self, capacity):
+        inside, straddling = self._split_buckets(capacity)
+        if any([bucket.count > 0 for bucket in inside]):
+            return True
+        if not straddling:
+            return False
+        return self._get_straddling_parcels(capacity).exists()
+
+    def get_load_within(self, capacity):
+        # (count, weight, volume) of the pending parcels that fit the capacity
+        inside, straddling = self._split_buckets(capacity)
+        count = sum([bucket.count for bucket in inside])
+        weight = sum([bucket.total_weight for bucket in inside])
+        volume = sum([bucket.total_volume for bucket in inside])
+
+        # only cells cut by the capacity edge need to look at the parcels themselves
+        if straddling:
+            edge = self._get_straddling_parcels(capacity).aggregate(count=Count('id'), total_weight=Sum('weight'), total_volume=Sum('volume'))
+            count += edge['count']
+            weight += edge['total_weight'] or 0
+            volume += edge['total_volume'] or 0
+
+        return (count, weight, volume)
+
+    def get_drift(self):
+        # (stored, counted) (count, weight, volume) of the backlog, for spotting a summary out of step with the parcels
+        summary = BacklogSummary.objects.filter(pk=self.SUMMARY_ID).first()
+        totals = self.get_pending_parcels().aggregate(count=Count('id'), total_weight=Sum('weight'), total_volume=Sum('volume'))
+        stored = (summary.count, summary.total_weight, summary.total_volume) if summary else None
+        return stored, (totals['count'], totals['total_weight'] or 0, totals['total_volume'] or 0)
+
+    @transaction.atomic
+    def rebuild(self):
+        pending = self.get_pending_parcels()
+        totals = pending.aggregate(count=Count('id'), total_weight=Sum('weight'), total_volume=Sum('volume'), min_weight=Min('weight'), min_volume=Min('volume'))
+        summary, _ = BacklogSummary.objects.update_or_create(pk=self.SUMMARY_ID, defaults={
+            'count': totals['count'],
+            'total_weight': totals['total_weight'] or 0,
+            'total_volume': totals['total_volume'] or 0,
+            'min_weight': totals['min_weight'],
+            'min_volume': totals['min_volume'],
+        })
+
+        buckets = {}
+        for weight, volume in pending.values_list('weight', 'volume').iterator(chunk_size=10000):
+            bucket = buckets.setdefault(self.bucket_of(weight, volume), [0, 0.0, 0.0])
+            bucket[0] += 1
+            bucket[1] += weight
+            bucket[2] += volume
+
+        BacklogBucket.objects.all().delete()
+        BacklogBucket.objects.bulk_create([
+            BacklogBucket(weight_bucket=key[0], volume_bucket=key[1], count=count, total_weight=weight, total_volume=volume)
+            for key, (count, weight, volume) in buckets.items()
+        ], batch_size=1000)
+        return summary
+
+    def _update_buckets(self, buckets, sign):
+        # cells are created empty first, then locked in a fixed order and written back in one statement
+        if sign > 0:
+            BacklogBucket.objects.bulk_create(
+                [BacklogBucket(weight_bucket=key[0], volume_bucket=key[1]) for key in buckets],
+                ignore_conflicts=True
+            )
+
+        keys = Q()
+        for weight_bucket, volume_bucket in buckets:
+            keys |= Q(weight_bucket=weight_bucket, volume_bucket=volume_bucket)
+        cells = list(BacklogBucket.objects.select_for_update().filter(keys).order_by('weight_bucket', 'volume_bucket'))
+
+        for cell in cells:
+            count, weight, volume = buckets[(cell.weight_bucket, cell.volume_bucket)]
+            cell.count += sign * count
+            cell.total_weight += sign * weight
+            cell.total_volume += sign * volume
+            if cell.count <= 0:
+                # emptied cells stay for the next deposit, only their float drift goes
+                cell.count, cell.total_weight, cell.total_volume = 0, 0, 0
+        BacklogBucket.objects.bulk_update(cells, ['count', 'total_weight', 'total_volume'], batch_size=1000)
+
+    def _group(self, parcels):
+        buckets = {}
+        for parcel in parcels:
+            # freshly deposited instances still hold the raw request values
+            weight, volume = float(parcel.weight), float(parcel.volume)
+            bucket = buckets.setdefault(self.bucket_of(weight, volume), [0, 0.0, 0.0])
+            bucket[0] += 1
+            bucket[1] += weight
+            bucket[2] += volume
+        return buckets
+
+    def _lower_minimum(self, field, value):
+        # an empty backlog takes the new value, an unknown minimum stays unknown until get_summary looks it up
+        return Case(
+            When(**{ field + '__isnull': False }, then=Least(F(field), Value(value))),
+            When(count=0, then=Value(value)),
+            default=F(field)
+        )
+
+    def _is_at_most(self, parcels, field, minimum):
+        return minimum is None or min([float(getattr(parcel, field)) for parcel in parcels]) <= minimum
+
+    def _split_buckets(self, capacity):
+        # a missing summary means the tables were never built, or were flushed or restored without them
+        if not BacklogSummary.objects.filter(pk=self.SUMMARY_ID).exists():
+            self.rebuild()
+
+        # cells below the edge cell fit whole, cells on the edge only partly
+        weight_edge, volume_edge = self.bucket_of(*capacity)
+        buckets = BacklogBucket.objects.filter(count__gt=0, weight_bucket__lte=weight_edge, volume_bucket__lte=volume_edge)
+        inside, straddling = [], []
+        for bucket in buckets:
+            if bucket.weight_bucket < weight_edge and bucket.volume_bucket < volume_edge:
+                inside.append(bucket)
+            else:
+                straddling.append(bucket)
+        return inside, straddling
+
+    def _get_straddling_parcels(self, capacity):
+        weight_capacity, volume_capacity = capacity
+        weight_edge, volume_edge = self.bucket_of(*capacity)
+        return self.get_pending_parcels().filter(weight__lte=weight_capacity, volume__lte=volume_capacity).filter(
+            Q(weight__gte=weight_edge * BacklogBucket.WEIGHT_BUCKET_SIZE) | Q(volume__gte=volume_edge * BacklogBucket.VOLUME_BUCKET_SIZE)
+        )
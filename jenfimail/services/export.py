@@ -0,0 +1,81 @@
+from django.core.serializers.json import DjangoJSONEncoder
+
+import csv
+import json
+
+from ..models import Parcel, Shipment
+
+class Echo():
+    """ File-like object csv.writer can write to, handing each row back instead of buffering it. """
+
+    def write(self, value):
+        return value
+
+class ExportService():
+    FORMAT_NDJSON = 'ndjson'
+    FORMAT_CSV = 'csv'
+    FORMATS = [FORMAT_NDJSON, FORMAT_CSV]
+
+    CONTENT_TYPES = {
+        FORMAT_NDJSON: 'application/x-ndjson',
+        FORMAT_CSV: 'text/csv',
+    }
+
+    PARCEL_FIELDS = ['id', 'label', 'weight', 'volume', 'cost', 'status', 'created_at', 'withdrawn_at', 'shipment_id']
+    SHIPMENT_FIELDS = ['id', 'train_id', 'line_id', 'status', 'departure_date', 'arrival_date', 'total_weight', 'total_volume', 'total_revenue', 'optimized_cost_per_weight']
+
+    # filter name -> lookup, per export
+    PARCEL_FILTERS = {
+        'created_after': 'created_at__gte',
+        'created_before': 'created_at__lt',
+        'withdrawn_after': 'withdrawn_at__gte',
+        'withdrawn_before': 'withdrawn_at__lt',
+        'departure_after': 'shipment__departure_date__gte',
+        'departure_before': 'shipment__departure_date__lt',
+    }
+    SHIPMENT_FILTERS = {
+        'departure_after': 'departure_date__gte',
+        'departure_before': 'departure_date__lt',
+    }
+
+    def __init__(self, **args):
+        self.chunk_size = int(args.get('chunk_size', 2000))
+
+    def get_parcels(self, filters):
+        parcels = (
+            Parcel.objects
+                .filter(**self._lookups(self.PARCEL_FILTERS, filters))
+                .select_related('shipment')
+                .only('id', 'label', 'weight', 'volume', 'cost', 'created_at', 'withdrawn_at', 'shipment', 'shipment__arrival_date')
+                .order_by('created_at', 'id')
+        )
+        return parcels.iterator(chunk_size=self.chunk_size)
+
+    def get_shipments(self, filters):
+        shipments = Shipment.objects.filter(**self._lookups(self.SHIPMENT_FILTERS, filters)).order_by('id')
+        return shipments.iterator(chunk_size=self.chunk_size)
+
+    def export_parcels(self, filters, format=FORMAT_NDJSON):
+        return self.render(self.get_parcels(filters), self.PARCEL_FIELDS, format)
+
+    def export_shipments(self, filters, format=FORMAT_NDJSON):
+        return self.render(self.get_shipments(filters), self.SHIPMENT_FIELDS, format)
+
+    def render(self, objects, fields, format):
+        rows = ([getattr(obj, field) for field in fields] for obj in objects)
+        if format == self.FORMAT_CSV:
+            return self._to_csv(rows, fields)
+        return self._to_ndjson(rows, fields)
+
+    def _to_ndjson(self, rows, fields):
+        for row in rows:
+            yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder) + '\n'
+
+    def _to_csv(self, rows, fields):
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        for row in rows:
+            yield writer.writerow(row)
+
+    def _lookups(self, lookups, filters):
+        return { lookups[name]: value for name, value in filters.items() if name in lookups and value is not None }
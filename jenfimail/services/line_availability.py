@@ -0,0 +1,67 @@
+from django.db.models import Max
+
+from datetime import datetime, timezone
+import threading
+import time
+
+from ..models import Shipment
+
+class LineAvailabilityIndex():
+    """ Process-local map of line id -> busy-until, so availability checks do not hit the database. """
+
+    def __init__(self, **args):
+        # other processes ship trains too, so the index is reloaded once it is this old
+        self.max_age_secs = float(args.get('max_age_secs', 60))
+        self.busy_until = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        utc_now = datetime.now(timezone.utc)
+        rows = (
+            Shipment.objects
+                .filter(arrival_date__gt=utc_now)
+                .values('line_id')
+                .annotate(busy_until=Max('arrival_date'))
+                .order_by()
+        )
+        busy_until = { row['line_id']: row['busy_until'] for row in rows }
+        with self.lock:
+            self.busy_until = busy_until
+            self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age_secs:
+            self.load()
+
+    def invalidate(self):
+        with self.lock:
+            self.busy_until = {}
+            self.loaded_at = None
+
+    def mark_busy(self, line_id, until):
+        self.ensure_loaded()
+        with self.lock:
+            current = self.busy_until.get(line_id)
+            if current is None or until > current:
+                self.busy_until[line_id] = until
+
+    def is_available(self, line_id, at=None):
+        self.ensure_loaded()
+        # the line frees up once its last train arrives; stale entries are dropped on the next load
+        until = self.busy_until.get(line_id)
+        return until is None or until <= (at or datetime.now(timezone.utc))
+
+    def get_available_at(self, line_id, at=None):
+        self.ensure_loaded()
+        at = at or datetime.now(timezone.utc)
+        until = self.busy_until.get(line_id)
+        return until if until is not None and until > at else at
+
+    def get_unavailable_lines(self, at=None):
+        self.ensure_loaded()
+        at = at or datetime.now(timezone.utc)
+        with self.lock:
+            return { line_id for line_id, until in self.busy_until.items() if until > at }
+
+line_availability_index = LineAvailabilityIndex()
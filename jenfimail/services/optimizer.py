@@ -1,63 +1,571 @@
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Sum, Min
+from django.conf import settings
 
-from pulp import LpMinimize, LpMaximize, LpProblem, LpStatus, lpSum, LpVariable
+from pulp import LpMinimize, LpMaximize, LpProblem, LpStatus, LpAffineExpression, LpVariable, PULP_CBC_CMD, HiGHS_CMD
+from datetime import datetime, timedelta, timezone
 import numpy as np
+import copy
+import math
+import os
+import tempfile
+import time
+import uuid
 
+from ..models import TrainLine
+from .optimizer_session import OptimizerSession
+from .solve_cache import solve_cache
+from ..instrumentation import instrumented, uninstrumented, solver_timed
+from ..custom_exceptions import SolverNotValidException, SolverNotAvailableException, SolverOptionNotSupportedException
+
+class AssignmentProblem():
+    """ Train x line incidence in array form; only the pairs a train actually runs on are kept. """
+
+    def __init__(self, lines, trains, pairs, parcel_load):
+        self.lines = lines
+        self.trains = trains
+        self.parcel_weight, self.parcel_volume = parcel_load
+
+        self.train_ids = np.fromiter((train.id for train in trains), dtype=np.int64, count=len(trains))
+        self.line_ids = np.fromiter(lines, dtype=np.int64, count=len(lines))
+        self.costs = np.fromiter((train.cost for train in trains), dtype=float, count=len(trains))
+        self.weight_capacities = np.fromiter((train.weight_capacity for train in trains), dtype=float, count=len(trains))
+        self.volume_capacities = np.fromiter((train.volume_capacity for train in trains), dtype=float, count=len(trains))
+
+        # pairs come in as (train_id, line_id) rows and are mapped to positional indexes
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.pair_trains = self._positions(self.train_ids, pairs[:, 0])
+        self.pair_lines = self._positions(self.line_ids, pairs[:, 1])
+        known = (self.pair_trains >= 0) & (self.pair_lines >= 0)
+        self.pair_trains, self.pair_lines = self.pair_trains[known], self.pair_lines[known]
+
+        order = np.lexsort((self.pair_lines, self.pair_trains))
+        self.pair_trains, self.pair_lines = self.pair_trains[order], self.pair_lines[order]
+
+        self.pair_costs = self.costs[self.pair_trains]
+        self.pair_weight_capacities = self.weight_capacities[self.pair_trains]
+        self.pair_volume_capacities = self.volume_capacities[self.pair_trains]
+
+    def collapse_lines(self):
+        # cost and capacity depend on the train alone, so one column per train on its first line is enough
+        problem = copy.copy(self)
+        firsts = np.unique(self.pair_trains, return_index=True)[1]
+        problem.pair_trains, problem.pair_lines = self.pair_trains[firsts], self.pair_lines[firsts]
+        problem.pair_costs = self.pair_costs[firsts]
+        problem.pair_weight_capacities = self.pair_weight_capacities[firsts]
+        problem.pair_volume_capacities = self.pair_volume_capacities[firsts]
+        return problem
+
+    @property
+    def no_of_pairs(self):
+        return len(self.pair_trains)
+
+    @property
+    def incidence(self):
+        matrix = np.zeros((len(self.line_ids), len(self.train_ids)))
+        matrix[self.pair_lines, self.pair_trains] = 1
+        return matrix
+
+    def _positions(self, ids, values):
+        # index of each value in ids, -1 when it is not part of the problem
+        if not len(ids):
+            return np.full(len(values), -1, dtype=np.int64)
+
+        order = np.argsort(ids)
+        found = np.searchsorted(ids, values, sorter=order)
+        found = np.clip(found, 0, len(ids) - 1)
+        positions = order[found]
+        return np.where(ids[positions] == values, positions, -1)
+
+class OptimizationResult():
+    """ (cost, schedule) plus solver diagnostics; unpacks like the plain tuple minimize_cost used to return. """
+
+    def __init__(self, cost, schedule, status, gap=None, wall_time=None, solver=None, assignment=None, proven=False):
+        self.cost = cost
+        self.schedule = schedule
+        self.assignment = assignment
+        self.status = status
+        self.gap = gap
+        self.wall_time = wall_time
+        self.solver = solver
+        # the solver proved the schedule optimal, or proved there is none
+        self.proven = proven
+
+    def __iter__(self):
+        return iter((self.cost, self.schedule))
+
+    @property
+    def is_feasible(self):
+        return self.schedule is not None
+
+# only the entry points are tracked, the helpers they call would add a series each per solve
+@instrumented
 class OptimizerService():
     LOWER_BOUND = 0
     SENSE = LpMinimize
     CAT_BINARY = 'Binary'
 
+    SOLVER_CBC = 'cbc'
+    SOLVER_HIGHS = 'highs'
+    SOLVER_GREEDY = 'greedy'
+    SOLVERS = [SOLVER_CBC, SOLVER_HIGHS, SOLVER_GREEDY]
+
+    STATUS_HEURISTIC = 'Heuristic'
+    # the solver stopped, usually on the time limit, with a schedule it could not prove optimal
+    STATUS_NOT_OPTIMAL = 'Not Optimal'
+
     def __init__(self, **args):
         self.problem_name = args.get('name', 'mail-scheduler')
         self.shift_duration_hrs = args.get('shift_duration', 3)
         self.shifts_per_day = 24 / self.shift_duration_hrs
 
-    def minimize_cost(self, lines, trains, parcels):
+        # solver configuration
+        self.solver = args.get('solver', self.SOLVER_CBC)
+        self.time_limit = args.get('time_limit')
+        self.mip_gap = args.get('mip_gap')
+        self.threads = args.get('threads')
+        self.verbose = bool(args.get('verbose', False))
+
+        # cost per unit of weight per hour a parcel waits, used by the timetable model
+        self.lateness_penalty = float(args.get('lateness_penalty', 0.01))
+
+        # parcel -> train assignment is solved exactly up to this many parcels, packed heuristically beyond
+        self.assignment_max_parcels = int(args.get('assignment_max_parcels', 300))
+
+        # identical problems are answered from here without running the solver, None turns it off
+        self.cache = args.get('cache', solve_cache)
+
+        if self.solver not in self.SOLVERS:
+            raise SolverNotValidException()
+        # HiGHS_CMD only takes command line switches, a relative gap cannot be passed through
+        if self.solver == self.SOLVER_HIGHS and self.mip_gap is not None:
+            raise SolverOptionNotSupportedException('mip_gap', self.solver)
+
+    @uninstrumented
+    def get_parcel_load(self, parcels):
+        totals = parcels.aggregate(weight=Sum('weight'), volume=Sum('volume'))
+        return (totals['weight'] or 0, totals['volume'] or 0)
+
+    @uninstrumented
+    def build_problem(self, lines, trains, parcels, parcel_load=None):
         lines = [line.id for line in lines]
         trains = list(trains)
-        parcel_volume = parcels.aggregate(Sum('volume')) #sum([parcel.volume for parcel in parcels])
-        parcel_weight = parcels.aggregate(Sum('weight')) #sum([parcel.weight for parcel in parcels])
+        pairs = list(TrainLine.objects.filter(
+            train_id__in=[train.id for train in trains],
+            line_id__in=lines
+        ).values_list('train_id', 'line_id'))
+        # callers that already know the totals, e.g. from the backlog summary, spare the aggregate
+        return AssignmentProblem(lines, trains, pairs, parcel_load or self.get_parcel_load(parcels))
 
+    @uninstrumented
+    def build_model(self, problem):
         model = LpProblem(name=self.problem_name, sense=self.SENSE)
 
-        # decision variables
-        no_of_variables = len(lines) * len(trains)
-        x = { i: LpVariable(name=f'x{i}', lowBound=self.LOWER_BOUND, cat=self.CAT_BINARY) for i in range(no_of_variables) }
-
-        # base matrix with the train X line constraint implemented
-        assignment_matrix = np.zeros((len(lines), len(trains)))
-        for (i, j), _ in np.ndenumerate(assignment_matrix):
-            assignment_matrix[i][j] = 1 if lines[i] in [line.id for line in trains[j].lines.all()] else 0
-        assignment_vector = assignment_matrix.flatten()
+        # decision variables, one per train x line pair the train can actually run
+        x = [
+            LpVariable(name=f'x_{problem.train_ids[t]}_{problem.line_ids[l]}', lowBound=self.LOWER_BOUND, cat=self.CAT_BINARY)
+            for t, l in zip(problem.pair_trains.tolist(), problem.pair_lines.tolist())
+        ]
 
         # objective function
-        model += lpSum(trains[i % len(trains)].cost * assignment_vector[i] * x[i] for i in range(no_of_variables)), 'cost'
+        model += LpAffineExpression(zip(x, problem.pair_costs.tolist())), 'cost'
 
         # constraints
-        model += (lpSum(trains[i % len(trains)].weight_capacity * assignment_vector[i] * x[i] for i in range(no_of_variables)) >= parcel_weight), 'parcel weight'
-        model += (lpSum(trains[i % len(trains)].volume_capacity * assignment_vector[i] * x[i] for i in range(no_of_variables)) >= parcel_volume), 'parcel volume'
-
-        for t in range(len(trains)):
-            model += (lpSum(assignment_vector[t + len(trains) * i] * x[t + len(trains) * i] for i in range(len(lines))) <= 1), 'train one-time' + str(trains[t].id)
-
-        print(model)
-        status = model.solve()
-
-        # infeasible
-        if status == -1:
-            return None, None
-
-        # map schedule
-        i = 0
-        schedule = []
-        for var in x.values():
-            if var.value() == 1:
-                schedule.append((
-                    trains[i % len(trains)],
-                    lines[int(i/len(lines))]
-                ))
-            i += 1
-
-        return model.objective.value(), schedule
+        model += (LpAffineExpression(zip(x, problem.pair_weight_capacities.tolist())) >= problem.parcel_weight), 'parcel weight'
+        model += (LpAffineExpression(zip(x, problem.pair_volume_capacities.tolist())) >= problem.parcel_volume), 'parcel volume'
+
+        # a train runs at most once; pairs are sorted by train so each train is a contiguous slice
+        boundaries = np.flatnonzero(np.diff(problem.pair_trains)) + 1
+        for block in np.split(np.arange(problem.no_of_pairs), boundaries):
+            if len(block) < 2:
+                continue
+            train_id = problem.train_ids[problem.pair_trains[block[0]]]
+            model += (LpAffineExpression((x[i], 1) for i in block.tolist()) <= 1), 'train one-time' + str(train_id)
+
+        return model, x
+
+    @uninstrumented
+    def get_solver(self, warm_start=False):
+        if self.solver == self.SOLVER_CBC:
+            # cbc only reports the bound it reached in its log, run_model reads it back from there
+            log_path = os.path.join(tempfile.gettempdir(), 'jenfimail-cbc-{}.log'.format(uuid.uuid4().hex))
+            return PULP_CBC_CMD(msg=False, logPath=log_path, timeLimit=self.time_limit, gapRel=self.mip_gap, threads=self.threads, warmStart=warm_start)
+
+        if self.solver == self.SOLVER_HIGHS:
+            options = ['--parallel on'] if self.threads and self.threads > 1 else []
+            solver = HiGHS_CMD(msg=self.verbose, timeLimit=self.time_limit, options=options)
+            if not solver.available():
+                raise SolverNotAvailableException()
+            return solver
+
+        return None
+
+    @uninstrumented
+    def solve_model(self, problem):
+        reduced = problem.collapse_lines()
+        model, x = self.build_model(reduced)
+        result = self.run_model(model, x, [problem.trains[t] for t in reduced.pair_trains.tolist()])
+        if result.schedule is not None:
+            result.schedule = self.spread_lines(problem, result.schedule)
+        return result
+
+    @uninstrumented
+    def spread_lines(self, problem, trains):
+        lines = {}
+        for t, l in zip(problem.pair_trains.tolist(), problem.pair_lines.tolist()):
+            lines.setdefault(problem.trains[t].id, []).append(int(problem.line_ids[l]))
+
+        # trains with the fewest lines pick first, each onto its least used line
+        usage, picked = {}, {}
+        for train in sorted(trains, key=lambda train: (len(lines[train.id]), train.id)):
+            line_id = min(lines[train.id], key=lambda line_id: (usage.get(line_id, 0), line_id))
+            usage[line_id] = usage.get(line_id, 0) + 1
+            picked[train.id] = line_id
+        return [(train, picked[train.id]) for train in trains]
+
+    @uninstrumented
+    @solver_timed
+    def run_model(self, model, x, pairs, solver=None):
+        if self.verbose:
+            print(model)
+
+        solver = solver or self.get_solver()
+        log_path = solver.optionsDict.get('logPath')
+        try:
+            started_at = time.perf_counter()
+            status = model.solve(solver)
+            wall_time = time.perf_counter() - started_at
+            gap = self.read_gap(log_path)
+        finally:
+            # a failed or killed solve leaves its log behind otherwise
+            if log_path and os.path.exists(log_path):
+                os.remove(log_path)
+
+        # infeasible, or the time limit ran out before any schedule was found
+        if status != 1 or model.sol_status not in (1, 2):
+            return OptimizationResult(None, None, self.get_status(status, model.sol_status), wall_time=wall_time, solver=self.solver, proven=status == -1)
+
+        schedule = [pairs[i] for i, var in enumerate(x) if round(var.value() or 0) == 1]
+        return OptimizationResult(
+            model.objective.value(),
+            schedule,
+            self.get_status(status, model.sol_status),
+            gap=gap,
+            wall_time=wall_time,
+            solver=self.solver,
+            proven=model.sol_status == 1
+        )
+
+    @uninstrumented
+    def get_status(self, status, sol_status):
+        # pulp reports a time limit stop with an incumbent as Optimal, only sol_status tells them apart
+        if sol_status == 1:
+            return LpStatus[1]
+        if sol_status == 2:
+            return self.STATUS_NOT_OPTIMAL
+        return LpStatus[0] if status == 1 else LpStatus[status]
+
+    @uninstrumented
+    def read_gap(self, log_path):
+        # relative gap between the objective and the best bound cbc reached, None when there is no log to read
+        if not log_path or not os.path.exists(log_path):
+            return None
+
+        with open(log_path) as log:
+            lines = log.read().splitlines()
+        if self.verbose:
+            print('\n'.join(lines))
+
+        objective, bound, optimal = None, None, False
+        for line in lines:
+            if line.startswith('Result - Optimal solution found'):
+                optimal = True
+            elif line.startswith('Objective value:'):
+                objective = float(line.split(':')[1])
+            elif line.startswith('Lower bound:') or line.startswith('Upper bound:'):
+                bound = float(line.split(':')[1])
+
+        if objective is None:
+            return None
+        if bound is None:
+            # cbc leaves the bound out once it closed the tree
+            return 0.0 if optimal else None
+        if objective == 0:
+            return 0.0 if bound == 0 else None
+        return abs(objective - bound) / abs(objective)
+
+    @uninstrumented
+    @solver_timed
+    def solve_greedy(self, problem):
+        started_at = time.perf_counter()
+        selected = self.greedy_cover(problem)
+        wall_time = time.perf_counter() - started_at
+
+        if selected is None:
+            return OptimizationResult(None, None, LpStatus[-1], wall_time=wall_time, solver=self.solver)
+
+        return OptimizationResult(
+            float(problem.pair_costs[selected].sum()),
+            self.get_schedule(problem, selected),
+            self.STATUS_HEURISTIC,
+            wall_time=wall_time,
+            solver=self.solver
+        )
+
+    @uninstrumented
+    def greedy_cover(self, problem):
+        # every train is a candidate once, on the first line it runs
+        firsts = np.unique(problem.pair_trains, return_index=True)[1]
+        weight_share = problem.pair_weight_capacities[firsts] / problem.parcel_weight if problem.parcel_weight else np.zeros(len(firsts))
+        volume_share = problem.pair_volume_capacities[firsts] / problem.parcel_volume if problem.parcel_volume else np.zeros(len(firsts))
+        coverage = weight_share + volume_share
+
+        # cheapest per unit of coverage first
+        with np.errstate(divide='ignore'):
+            score = np.where(coverage > 0, problem.pair_costs[firsts] / coverage, np.inf)
+
+        selected, weight, volume = [], 0.0, 0.0
+        for i in firsts[np.argsort(score, kind='stable')].tolist():
+            if weight >= problem.parcel_weight and volume >= problem.parcel_volume:
+                break
+            selected.append(i)
+            weight += problem.pair_weight_capacities[i]
+            volume += problem.pair_volume_capacities[i]
+
+        if weight < problem.parcel_weight or volume < problem.parcel_volume:
+            return None
+
+        # drop the most expensive trains the load can do without
+        for i in sorted(selected, key=lambda i: -problem.pair_costs[i]):
+            if weight - problem.pair_weight_capacities[i] >= problem.parcel_weight and volume - problem.pair_volume_capacities[i] >= problem.parcel_volume:
+                selected.remove(i)
+                weight -= problem.pair_weight_capacities[i]
+                volume -= problem.pair_volume_capacities[i]
+
+        return sorted(selected)
+
+    @uninstrumented
+    def get_schedule(self, problem, selected):
+        return [
+            (problem.trains[problem.pair_trains[i]], int(problem.line_ids[problem.pair_lines[i]]))
+            for i in selected
+        ]
+
+    def solve(self, lines, trains, parcels, parcel_load=None):
+        problem = self.build_problem(lines, trains, parcels, parcel_load=parcel_load)
+        if self.cache is None:
+            return self.solve_problem(problem)
+
+        key = self.cache.fingerprint(problem, self.solver, self.time_limit, self.mip_gap)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return self.from_cache(problem, cached)
+
+        result = self.solve_problem(problem)
+        # only answers the solver proved are kept, a run stopped by the time limit may do better next time
+        if result.proven:
+            self.cache.set(key, self.to_cache(result))
+        return result
+
+    @uninstrumented
+    def solve_problem(self, problem):
+        if self.solver == self.SOLVER_GREEDY:
+            return self.solve_greedy(problem)
+
+        return self.solve_model(problem)
+
+    @uninstrumented
+    def to_cache(self, result):
+        schedule = [(train.id, line_id) for train, line_id in result.schedule] if result.is_feasible else None
+        return (result.cost, schedule, result.status, result.gap, result.wall_time, result.proven)
+
+    @uninstrumented
+    def from_cache(self, problem, cached):
+        # schedules are stored by id and handed back with this call's train instances
+        cost, schedule, status, gap, wall_time, proven = cached
+        if schedule is not None:
+            trains = { train.id: train for train in problem.trains }
+            schedule = [(trains[train_id], line_id) for train_id, line_id in schedule]
+        return OptimizationResult(cost, schedule, status, gap=gap, wall_time=wall_time, solver=self.solver, proven=proven)
+
+    @uninstrumented
+    def build_timetable_model(self, problem, start, horizon_shifts, line_available_at, backlog_age_hrs):
+        model = LpProblem(name=self.problem_name + '-timetable', sense=self.SENSE)
+        window = max(1, math.ceil(settings.TRAIN_TRAVEL_TIME_HRS / self.shift_duration_hrs))
+
+        # decision variables over train x line x shift, skipping shifts before a line frees up
+        x, entries = [], []
+        train_vars, line_shift_vars = {}, {}
+        for i, (t, l) in enumerate(zip(problem.pair_trains.tolist(), problem.pair_lines.tolist())):
+            train, line_id = problem.trains[t], int(problem.line_ids[l])
+            for shift in range(horizon_shifts):
+                departure_date = start + timedelta(hours=shift * self.shift_duration_hrs)
+                if departure_date < line_available_at.get(line_id, start):
+                    continue
+
+                var = LpVariable(name=f'x_{train.id}_{line_id}_{shift}', lowBound=self.LOWER_BOUND, cat=self.CAT_BINARY)
+                x.append(var)
+                entries.append((train, line_id, departure_date))
+                train_vars.setdefault(train.id, []).append(var)
+                line_shift_vars.setdefault(line_id, {}).setdefault(shift, []).append(var)
+
+        # objective function: train cost plus the wait of the load it takes, counted from the oldest parcel
+        costs = np.fromiter((train.cost for train, _, _ in entries), dtype=float, count=len(entries))
+        loads = np.minimum(np.fromiter((train.weight_capacity for train, _, _ in entries), dtype=float, count=len(entries)), problem.parcel_weight)
+        waits = np.fromiter(((departure_date - start).total_seconds() / 3600 for _, _, departure_date in entries), dtype=float, count=len(entries)) + backlog_age_hrs
+        model += LpAffineExpression(zip(x, (costs + self.lateness_penalty * loads * waits).tolist())), 'cost'
+
+        # constraints
+        model += (LpAffineExpression((var, train.weight_capacity) for var, (train, _, _) in zip(x, entries)) >= problem.parcel_weight), 'parcel weight'
+        model += (LpAffineExpression((var, train.volume_capacity) for var, (train, _, _) in zip(x, entries)) >= problem.parcel_volume), 'parcel volume'
+
+        for train_id, variables in train_vars.items():
+            if len(variables) > 1:
+                model += (LpAffineExpression((var, 1) for var in variables) <= 1), 'train one-time' + str(train_id)
+
+        # a line carries one departure per travel window
+        for line_id, shifts in line_shift_vars.items():
+            for shift in range(horizon_shifts):
+                variables = [var for s in range(shift, shift + window) for var in shifts.get(s, [])]
+                if len(variables) > 1:
+                    model += (LpAffineExpression((var, 1) for var in variables) <= 1), 'line window {} {}'.format(line_id, shift)
+
+        return model, x, entries
+
+    def minimize_cost_timetable(self, lines, trains, parcels, **args):
+        if self.solver == self.SOLVER_GREEDY:
+            raise SolverNotValidException()
+
+        start = args.get('start') or datetime.now(timezone.utc)
+        horizon_shifts = int(args.get('horizon_shifts') or self.shifts_per_day)
+        line_available_at = args.get('line_available_at', {})
+
+        oldest = parcels.aggregate(oldest=Min('created_at'))['oldest']
+        backlog_age_hrs = max(0.0, (start - oldest).total_seconds() / 3600) if oldest else 0.0
+
+        problem = self.build_problem(lines, trains, parcels, parcel_load=args.get('parcel_load'))
+        model, x, entries = self.build_timetable_model(problem, start, horizon_shifts, line_available_at, backlog_age_hrs)
+        result = self.run_model(model, x, entries)
+
+        # report what the trains cost; the objective also carries the lateness penalty
+        if result.schedule is not None:
+            result.schedule.sort(key=lambda entry: (entry[2], entry[1], entry[0].id))
+            result.cost = sum([train.cost for train, _, _ in result.schedule])
+        return result
+
+    @uninstrumented
+    def get_parcel_arrays(self, parcels):
+        rows = list(parcels.values_list('id', 'weight', 'volume'))
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        weights = np.fromiter((row[1] for row in rows), dtype=float, count=len(rows))
+        volumes = np.fromiter((row[2] for row in rows), dtype=float, count=len(rows))
+        return ids, weights, volumes
+
+    @uninstrumented
+    def build_assignment_model(self, problem, weights, volumes):
+        model, x = self.build_model(problem)
+
+        # z[p, t] only where parcel p fits train t on its own
+        fits = (weights[:, None] <= problem.weight_capacities[None, :]) & (volumes[:, None] <= problem.volume_capacities[None, :])
+        fits[:, np.setdiff1d(np.arange(len(problem.trains)), problem.pair_trains)] = False
+        parcel_index, train_index = np.nonzero(fits)
+        z = [
+            LpVariable(name=f'z_{p}_{problem.train_ids[t]}', lowBound=self.LOWER_BOUND, cat=self.CAT_BINARY)
+            for p, t in zip(parcel_index.tolist(), train_index.tolist())
+        ]
+
+        # every parcel rides exactly one train
+        by_parcel = {}
+        for var, p in zip(z, parcel_index.tolist()):
+            by_parcel.setdefault(p, []).append(var)
+        for p, variables in by_parcel.items():
+            model += (LpAffineExpression((var, 1) for var in variables) == 1), 'parcel ' + str(p)
+
+        # what a train carries fits its capacity, and only a train that runs carries anything
+        runs = {}
+        for var, t in zip(x, problem.pair_trains.tolist()):
+            runs.setdefault(t, []).append(var)
+        loads = {}
+        for var, p, t in zip(z, parcel_index.tolist(), train_index.tolist()):
+            loads.setdefault(t, []).append((var, p))
+        for t, load in loads.items():
+            train_id = problem.train_ids[t]
+            model += (LpAffineExpression([(var, weights[p]) for var, p in load] + [(var, -problem.weight_capacities[t]) for var in runs[t]]) <= 0), 'train weight ' + str(train_id)
+            model += (LpAffineExpression([(var, volumes[p]) for var, p in load] + [(var, -problem.volume_capacities[t]) for var in runs[t]]) <= 0), 'train volume ' + str(train_id)
+
+        return model, x, z, parcel_index, train_index, len(by_parcel) == len(weights)
+
+    @uninstrumented
+    def solve_assignment(self, problem, parcel_ids, weights, volumes):
+        model, x, z, parcel_index, train_index, packable = self.build_assignment_model(problem, weights, volumes)
+        if not packable:
+            return OptimizationResult(None, None, LpStatus[-1], solver=self.solver)
+
+        result = self.run_model(model, x, self.get_schedule(problem, range(problem.no_of_pairs)))
+        if result.schedule is None:
+            # the time limit ran out before an incumbent was found, fall back to packing
+            if result.status != LpStatus[-1]:
+                return self.pack_assignment(problem, parcel_ids, weights, volumes)
+            return result
+
+        result.assignment = {}
+        for var, p, t in zip(z, parcel_index.tolist(), train_index.tolist()):
+            if round(var.value() or 0) == 1:
+                result.assignment.setdefault(int(problem.train_ids[t]), []).append(int(parcel_ids[p]))
+        return result
+
+    @uninstrumented
+    @solver_timed
+    def pack_assignment(self, problem, parcel_ids, weights, volumes):
+        started_at = time.perf_counter()
+        firsts = np.unique(problem.pair_trains, return_index=True)[1]
+        trains = problem.pair_trains[firsts]
+
+        # trains are opened cheapest per unit of capacity first; parcels go biggest first
+        total_weight, total_volume = weights.sum() or 1, volumes.sum() or 1
+        coverage = problem.weight_capacities[trains] / total_weight + problem.volume_capacities[trains] / total_volume
+        order = np.argsort(problem.costs[trains] / coverage, kind='stable')
+        trains, firsts = trains[order], firsts[order]
+        sizes = np.maximum(weights / (problem.weight_capacities.max(initial=0) or 1), volumes / (problem.volume_capacities.max(initial=0) or 1))
+
+        remaining_weight = problem.weight_capacities[trains].astype(float)
+        remaining_volume = problem.volume_capacities[trains].astype(float)
+        opened = np.zeros(len(trains), dtype=bool)
+        assignment = {}
+        for p in np.argsort(-sizes, kind='stable').tolist():
+            fits = (remaining_weight >= weights[p]) & (remaining_volume >= volumes[p])
+            candidates = np.flatnonzero(fits & opened)
+            if not len(candidates):
+                candidates = np.flatnonzero(fits)
+            if not len(candidates):
+                return OptimizationResult(None, None, LpStatus[-1], wall_time=time.perf_counter() - started_at, solver=self.solver)
+
+            k = candidates[0]
+            opened[k] = True
+            remaining_weight[k] -= weights[p]
+            remaining_volume[k] -= volumes[p]
+            assignment.setdefault(int(problem.train_ids[trains[k]]), []).append(int(parcel_ids[p]))
+
+        selected = sorted(firsts[opened].tolist())
+        return OptimizationResult(
+            float(problem.pair_costs[selected].sum()),
+            self.get_schedule(problem, selected),
+            self.STATUS_HEURISTIC,
+            wall_time=time.perf_counter() - started_at,
+            solver=self.solver,
+            assignment=assignment
+        )
+
+    def minimize_cost_assignment(self, lines, trains, parcels):
+        problem = self.build_problem(lines, trains, parcels)
+        parcel_ids, weights, volumes = self.get_parcel_arrays(parcels)
+
+        if self.solver == self.SOLVER_GREEDY or len(parcel_ids) > self.assignment_max_parcels:
+            return self.pack_assignment(problem, parcel_ids, weights, volumes)
+        return self.solve_assignment(problem, parcel_ids, weights, volumes)
+
+    def create_session(self, lines, trains, parcels):
+        return OptimizerSession(self, self.build_problem(lines, trains, parcels))
+
+    def minimize_cost(self, lines, trains, parcels, parcel_load=None):
+        return self.solve(lines, trains, parcels, parcel_load=parcel_load)
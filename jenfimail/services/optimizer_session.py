@@ -0,0 +1,109 @@
+from pulp import LpAffineExpression, LpVariable
+
+from ..models import TrainLine
+from ..custom_exceptions import SolverNotValidException
+
+class OptimizerSession():
+    """ Keeps the last model and incumbent around so train and parcel changes re-solve from a warm start. """
+
+    def __init__(self, optimizer_service, problem):
+        if optimizer_service.solver == optimizer_service.SOLVER_GREEDY:
+            raise SolverNotValidException()
+
+        self.optimizer_service = optimizer_service
+        self.model, x = optimizer_service.build_model(problem)
+        self.line_ids = set(problem.line_ids.tolist())
+
+        # (train_id, line_id) -> variable, and the schedule entry each variable stands for
+        self.variables = {}
+        self.pairs = {}
+        for i, var in enumerate(x):
+            train = problem.trains[problem.pair_trains[i]]
+            line_id = int(problem.line_ids[problem.pair_lines[i]])
+            self.variables[(train.id, line_id)] = var
+            self.pairs[var.name] = (train, line_id)
+
+        self.trains = { train.id: train for train in problem.trains }
+        self.result = None
+
+    @property
+    def weight_constraint(self):
+        return self.model.constraints['parcel_weight']
+
+    @property
+    def volume_constraint(self):
+        return self.model.constraints['parcel_volume']
+
+    def add_train(self, train, line_ids):
+        line_ids = [line_id for line_id in line_ids if line_id in self.line_ids]
+        self.trains[train.id] = train
+
+        added = []
+        for line_id in line_ids:
+            var = self.variables.get((train.id, line_id))
+            if var is None:
+                var = LpVariable(
+                    name=f'x_{train.id}_{line_id}',
+                    lowBound=self.optimizer_service.LOWER_BOUND,
+                    cat=self.optimizer_service.CAT_BINARY
+                )
+                self.variables[(train.id, line_id)] = var
+                self.model.objective[var] = train.cost
+                self.weight_constraint[var] = train.weight_capacity
+                self.volume_constraint[var] = train.volume_capacity
+            var.upBound = 1
+            self.pairs[var.name] = (train, line_id)
+            added.append(var)
+
+        name = 'train_one_time' + str(train.id)
+        if len(added) > 1 and name not in self.model.constraints:
+            self.model += (LpAffineExpression((var, 1) for var in added) <= 1), name
+
+        return added
+
+    def remove_train(self, train_id):
+        # removed columns are pinned to zero rather than dropped, so the model can be reused as is
+        self.trains.pop(train_id, None)
+        for (var_train_id, _), var in self.variables.items():
+            if var_train_id == train_id:
+                var.upBound = 0
+                var.setInitialValue(0)
+
+    def sync_trains(self, trains):
+        trains = list(trains)
+        current = { train.id for train in trains }
+        for train_id in set(self.trains) - current:
+            self.remove_train(train_id)
+
+        added = [train for train in trains if train.id not in self.trains]
+        if not added:
+            return
+
+        lines = { train.id: [] for train in added }
+        for train_id, line_id in TrainLine.objects.filter(train_id__in=lines.keys()).values_list('train_id', 'line_id'):
+            lines[train_id].append(line_id)
+        for train in added:
+            self.add_train(train, lines[train.id])
+
+    def update_parcel_load(self, weight, volume):
+        self.weight_constraint.changeRHS(weight or 0)
+        self.volume_constraint.changeRHS(volume or 0)
+
+    def refresh(self, trains, parcels):
+        self.sync_trains(trains)
+        self.update_parcel_load(*self.optimizer_service.get_parcel_load(parcels))
+        return self.resolve()
+
+    def resolve(self):
+        # the previous schedule is handed to the solver as its starting incumbent
+        warm_start = self.result is not None and self.result.is_feasible
+        if warm_start:
+            for var in self.variables.values():
+                if var.upBound != 0:
+                    var.setInitialValue(round(var.value() or 0))
+
+        solver = self.optimizer_service.get_solver(warm_start=warm_start)
+        x = list(self.variables.values())
+        pairs = [self.pairs.get(var.name) for var in x]
+        self.result = self.optimizer_service.run_model(self.model, x, pairs, solver=solver)
+        return self.result
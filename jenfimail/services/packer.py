@@ -0,0 +1,169 @@
+import numpy as np
+
+from ..models import Parcel
+from ..custom_exceptions import PackingStrategyNotValidException
+
+class PackerService():
+    STRATEGY_FIFO = 'fifo'
+    STRATEGY_DENSITY = 'density'
+    STRATEGY_EXACT = 'exact'
+    STRATEGIES = [STRATEGY_FIFO, STRATEGY_DENSITY, STRATEGY_EXACT]
+
+    CANDIDATE_FIELDS = ('id', 'weight', 'volume', 'created_at')
+
+    def __init__(self, **args):
+        self.strategy = args.get('strategy', self.STRATEGY_FIFO)
+        self.exact_max_items = int(args.get('exact_max_items', 20))
+        self.max_claim_attempts = int(args.get('max_claim_attempts', 10))
+
+        if self.strategy not in self.STRATEGIES:
+            raise PackingStrategyNotValidException()
+
+    def load_candidates(self, capacity):
+        # one read: every pending parcel that fits an empty train, in FIFO order
+        weight_capacity, volume_capacity = capacity
+        parcels = list(
+            Parcel.objects
+                .filter(weight__lte=weight_capacity, volume__lte=volume_capacity, shipment=None, withdrawn_at=None)
+                .only(*self.CANDIDATE_FIELDS)
+                .order_by('created_at', 'id')
+        )
+        weights = np.fromiter((parcel.weight for parcel in parcels), dtype=float, count=len(parcels))
+        volumes = np.fromiter((parcel.volume for parcel in parcels), dtype=float, count=len(parcels))
+        return parcels, weights, volumes
+
+    def pack(self, capacity, strategy=None, lock=False):
+        weight_capacity, volume_capacity = capacity
+        if not weight_capacity or not volume_capacity:
+            return []
+
+        strategy = strategy or self.strategy
+        if strategy not in self.STRATEGIES:
+            raise PackingStrategyNotValidException()
+
+        parcels, weights, volumes = self.load_candidates(capacity)
+        if not parcels:
+            return []
+
+        if lock:
+            selected = self.claim(capacity, strategy, parcels, weights, volumes)
+        else:
+            selected = self.select(capacity, strategy, weights, volumes)
+
+        # loads are always handed over in FIFO order
+        return [parcels[i] for i in sorted(selected)]
+
+    def pack_many(self, capacities, strategy=None):
+        # fills several trains in order from a single read, without handing a parcel out twice
+        strategy = strategy or self.strategy
+        if strategy not in self.STRATEGIES:
+            raise PackingStrategyNotValidException()
+
+        loads = [[] for _ in capacities]
+        if not capacities:
+            return loads
+
+        parcels, weights, volumes = self.load_candidates((
+            max([weight for weight, volume in capacities]),
+            max([volume for weight, volume in capacities])
+        ))
+        available = np.ones(len(parcels), dtype=bool)
+        for k, (weight_capacity, volume_capacity) in enumerate(capacities):
+            if not weight_capacity or not volume_capacity:
+                continue
+
+            candidates = np.flatnonzero(available & (weights <= weight_capacity) & (volumes <= volume_capacity))
+            picked = candidates[self.select((weight_capacity, volume_capacity), strategy, weights[candidates], volumes[candidates])]
+            available[picked] = False
+            loads[k] = [parcels[i] for i in sorted(picked.tolist())]
+
+        return loads
+
+    def select(self, capacity, strategy, weights, volumes):
+        if strategy == self.STRATEGY_DENSITY:
+            return self.first_fit(capacity, weights, volumes, self.density_order(weights, volumes))
+        if strategy == self.STRATEGY_EXACT:
+            return self.branch_and_bound(capacity, weights, volumes)
+        return self.first_fit(capacity, weights, volumes, np.arange(len(weights)))
+
+    def claim(self, capacity, strategy, parcels, weights, volumes):
+        # only the picked rows are locked; rows another dispatcher holds are skipped and the
+        # freed capacity is packed again from the remaining candidates
+        remaining_weight, remaining_volume = capacity
+        available = np.ones(len(parcels), dtype=bool)
+        claimed = []
+        for _ in range(self.max_claim_attempts):
+            candidates = np.flatnonzero(available)
+            picked = candidates[self.select((remaining_weight, remaining_volume), strategy, weights[candidates], volumes[candidates])]
+            if not len(picked):
+                break
+
+            locked = set(
+                Parcel.objects
+                    .filter(id__in=[parcels[i].id for i in picked], shipment=None, withdrawn_at=None)
+                    .select_for_update(skip_locked=True)
+                    .values_list('id', flat=True)
+            )
+            for i in picked.tolist():
+                if parcels[i].id in locked:
+                    claimed.append(i)
+                    remaining_weight -= weights[i]
+                    remaining_volume -= volumes[i]
+            available[picked] = False
+
+            if len(locked) == len(picked):
+                break
+
+        return claimed
+
+    def density_order(self, weights, volumes):
+        # heaviest per unit volume first, FIFO among equals
+        densities = weights / volumes
+        return np.lexsort((np.arange(len(weights)), -densities))
+
+    def first_fit(self, capacity, weights, volumes, order):
+        remaining_weight, remaining_volume = capacity
+        weights, volumes = weights.tolist(), volumes.tolist()
+        selected = []
+        for i in order.tolist():
+            if weights[i] > remaining_weight or volumes[i] > remaining_volume:
+                continue
+
+            remaining_weight -= weights[i]
+            remaining_volume -= volumes[i]
+            selected.append(i)
+
+        return selected
+
+    def branch_and_bound(self, capacity, weights, volumes):
+        # exact search is only bounded for small sets, fall back to the greedy beyond that
+        if len(weights) > self.exact_max_items:
+            return self.first_fit(capacity, weights, volumes, self.density_order(weights, volumes))
+
+        order = self.density_order(weights, volumes).tolist()
+        item_weights = [float(weights[i]) for i in order]
+        item_volumes = [float(volumes[i]) for i in order]
+        suffix_weights = np.cumsum(item_weights[::-1])[::-1].tolist() + [0.0]
+
+        best = {
+            'weight': -1.0,
+            'items': [],
+        }
+
+        def search(k, remaining_weight, remaining_volume, loaded_weight, items):
+            if loaded_weight > best['weight']:
+                best['weight'] = loaded_weight
+                best['items'] = list(items)
+
+            if k == len(order) or loaded_weight + suffix_weights[k] <= best['weight']:
+                return
+
+            if item_weights[k] <= remaining_weight and item_volumes[k] <= remaining_volume:
+                items.append(order[k])
+                search(k + 1, remaining_weight - item_weights[k], remaining_volume - item_volumes[k], loaded_weight + item_weights[k], items)
+                items.pop()
+
+            search(k + 1, remaining_weight, remaining_volume, loaded_weight, items)
+
+        search(0, capacity[0], capacity[1], 0.0, [])
+        return best['items']
@@ -1,22 +1,55 @@
+from django.db import transaction
+
 from datetime import datetime, timedelta, timezone
 
-from ..models import Parcel
+from ..models import Parcel, ArchivedParcel
+from ..serializers import ParcelSerializer, ArchivedParcelSerializer
 from ..custom_exceptions import ParcelNotPendingException
+from .packer import PackerService
+from .backlog import BacklogService
+from .solve_cache import solve_cache
+from .status_cache import status_cache
+from ..instrumentation import instrumented, uninstrumented
 
+@instrumented
 class ParcelService():
-
+    def __init__(self, **args):
+        self.packer = args.get('packer') or PackerService(
+            strategy=args.get('packing_strategy', PackerService.STRATEGY_FIFO),
+            exact_max_items=args.get('exact_max_items', 20)
+        )
+        self.bulk_chunk_size = int(args.get('bulk_chunk_size', 1000))
+        self.solve_cache = args.get('solve_cache', solve_cache)
+        self.status_cache = args.get('status_cache', status_cache)
+        self.backlog = args.get('backlog') or BacklogService()
+
+    @transaction.atomic
     def deposit_parcel(self, data):
         parcel = Parcel(**data)
         parcel.save()
+        self.backlog.add([parcel])
+        self.solve_cache.invalidate()
         return parcel
 
+    @transaction.atomic
+    def deposit_parcels(self, data_list):
+        parcels = [Parcel(**data) for data in data_list]
+        parcels = Parcel.objects.bulk_create(parcels, batch_size=self.bulk_chunk_size)
+        self.backlog.add(parcels)
+        self.solve_cache.invalidate()
+        return parcels
+
+    @transaction.atomic
     def withdraw_parcel(self, parcel_id):
-        parcel = Parcel.objects.get(pk=parcel_id)
+        parcel = Parcel.objects.select_for_update().get(pk=parcel_id)
         if parcel.status != Parcel.STATUS_PENDING:
             raise ParcelNotPendingException()
 
         parcel.withdrawn_at = datetime.now(timezone.utc)
         parcel.save()
+        self.backlog.remove([parcel])
+        self.solve_cache.invalidate()
+        self.status_cache.invalidate_parcels([parcel.id])
         return parcel
 
     """
@@ -42,6 +75,42 @@ class ParcelService():
 
         return parcel.status == Parcel.STATUS_SHIPPED
 
+    def get_parcel_status(self, parcel_id):
+        return self.status_cache.get_parcel_status(parcel_id, lambda: self._load_parcel_status(parcel_id))
+
+    def _load_parcel_status(self, parcel_id):
+        try:
+            parcel = ParcelSerializer.setup_eager_loading(Parcel.objects).get(pk=parcel_id)
+        except Parcel.DoesNotExist:
+            # shipped and withdrawn parcels end up in the archive, whose status never changes again
+            archived = ArchivedParcel.objects.filter(pk=parcel_id).first()
+            if archived is None:
+                raise
+            return dict(ArchivedParcelSerializer(archived).data), None
+        return dict(ParcelSerializer(parcel).data), parcel.shipment.arrival_date if parcel.shipment else None
+
+    async def aget_parcel_status(self, parcel_id):
+        # same cache entry as the sync read, loaded with the async orm on a miss
+        return await self.status_cache.aget_parcel_status(parcel_id, lambda: self._aload_parcel_status(parcel_id))
+
+    async def _aload_parcel_status(self, parcel_id):
+        try:
+            parcel = await ParcelSerializer.setup_eager_loading(Parcel.objects).aget(pk=parcel_id)
+        except Parcel.DoesNotExist:
+            archived = await ArchivedParcel.objects.filter(pk=parcel_id).afirst()
+            if archived is None:
+                raise
+            return dict(ArchivedParcelSerializer(archived).data), None
+        return dict(ParcelSerializer(parcel).data), parcel.shipment.arrival_date if parcel.shipment else None
+
+    def get_parcel_statuses(self, parcel_ids):
+        # status reads the joined shipment, so the whole batch is one query
+        return list(Parcel.objects.filter(id__in=parcel_ids).select_related('shipment'))
+
+    def get_archived_parcel_statuses(self, parcel_ids):
+        return list(ArchivedParcel.objects.filter(id__in=parcel_ids))
+
+    @uninstrumented
     def get_parcels_within_capacity(self, capacity):
         weight_capacity, volume_capacity = capacity
         return Parcel.objects.filter(volume__lte=volume_capacity, weight__lte=weight_capacity, shipment=None, withdrawn_at=None)
@@ -51,32 +120,10 @@ class ParcelService():
         if not weight_capacity or not volume_capacity:
             return False
 
-        try:
-            return bool(self.get_parcels_within_capacity(capacity).first())
-        except Parcel.DoesNotExist:
-            return False
+        return self.backlog.has_parcels_within(capacity)
 
-    def get_parcels_to_fill_capacity(self, capacity):
-        result = []
-        weight_capacity, volume_capacity = capacity
-        if not weight_capacity or not volume_capacity:
-            return result
-
-        remaining_capacity = capacity
-        while self.is_fillable(remaining_capacity):
-            try:
-                parcels = self.get_parcels_within_capacity(remaining_capacity)
-                for parcel in parcels:
-                    if parcel.weight > remaining_capacity[0] or parcel.volume > remaining_capacity[1]:
-                        break
-
-                    remaining_capacity = (
-                        remaining_capacity[0] - parcel.weight,
-                        remaining_capacity[1] - parcel.volume
-                    )
-                    result.append(parcel)
-
-            except Parcel.DoesNotExist:
-                break
-
-        return result
+    def get_parcels_to_fill_capacity(self, capacity, strategy=None, lock=False):
+        return self.packer.pack(capacity, strategy=strategy, lock=lock)
+
+    def get_parcels_to_fill_capacities(self, capacities, strategy=None):
+        return self.packer.pack_many(capacities, strategy=strategy)
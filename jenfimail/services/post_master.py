@@ -1,12 +1,20 @@
 from django.db import transaction
+from django.db.models import Sum
 from django.conf import settings
+from django_fsm import TransitionNotAllowed
 
 from datetime import datetime, timedelta, timezone
+import math
 
-from ..models import Line, Train, Parcel, Shipment
-from ..serializers import ParcelSerializer
+from ..models import Line, Train, Parcel, Shipment, ShipmentParcel
+from ..serializers import ParcelSerializer, ArchivedParcelSerializer
+from .line_availability import line_availability_index
+from .solve_cache import solve_cache
+from .status_cache import status_cache
+from ..instrumentation import instrumented
 from ..custom_exceptions import LineNotValidException, LineNotAvailableException, NoParcelsToLoadException, FailedToLoadParcelsException
 
+@instrumented
 class PostMasterService():
     def __init__(self, train_service, parcel_service, optimizer_service, **args):
         self.train_service = train_service
@@ -14,18 +22,26 @@ class PostMasterService():
         self.optimizer_service = optimizer_service
 
         self.profit_margin_percentage = float(args.get('profit_margin_percentage', 0))
+        self.bulk_chunk_size = int(args.get('bulk_chunk_size', 1000))
+        self.line_availability = args.get('line_availability', line_availability_index)
+        self.solve_cache = args.get('solve_cache', solve_cache)
+        self.status_cache = args.get('status_cache', status_cache)
 
     def create_line(self, data):
         line = Line(**data)
         line.save()
         return line
 
-    def get_unavailable_lines(self, train):
-        utc_now = datetime.now(timezone.utc)
-        in_transit_shipments = Shipment.objects.filter(arrival_date__gt=utc_now).all()
-        return [shipment.line for shipment in in_transit_shipments]
+    def get_unavailable_lines(self, train=None):
+        return self.line_availability.get_unavailable_lines()
+
+    def is_line_available(self, line):
+        return self.line_availability.is_available(line.id)
 
     def get_train_status(self, train_id):
+        return self.status_cache.get_train_status(train_id, lambda: self._load_train_status(train_id))
+
+    def _load_train_status(self, train_id):
         status = {
             'line': None,
             'departure_date': None,
@@ -34,75 +50,266 @@ class PostMasterService():
         try:
             shipment = Shipment.objects.get(train__id=train_id)
         except Shipment.DoesNotExist:
-            return status
+            return status, None
 
-        status['line'] = shipment.line.id
+        status['line'] = shipment.line_id
         status['departure_date'] = shipment.departure_date
-        status['parcels'] = ParcelSerializer(shipment.parcels, many=True).data
+        serializer = self._get_parcels_serializer(shipment)
+        status['parcels'] = [dict(parcel) for parcel in serializer(serializer.setup_eager_loading(self._get_shipment_parcels(shipment)), many=True).data]
+
+        return status, shipment.arrival_date
+
+    def _get_shipment_parcels(self, shipment):
+        # an archived shipment moved all of its parcels at once
+        return shipment.archived_parcels.all() if shipment.archived_at else shipment.parcels.all()
+
+    def _get_parcels_serializer(self, shipment):
+        return ArchivedParcelSerializer if shipment.archived_at else ParcelSerializer
 
-        return status
+    def get_train_statuses(self, train_ids):
+        # one query: the shipment is joined in, the parcel list stays on the per-train endpoint
+        statuses = []
+        for train in Train.objects.filter(id__in=train_ids).select_related('shipment').order_by('id'):
+            shipment = train.shipment if hasattr(train, 'shipment') else None
+            statuses.append({
+                'id': train.id,
+                'status': train.status,
+                'shipment': shipment.id if shipment else None,
+                'shipment_status': shipment.status if shipment else None,
+                'line': shipment.line_id if shipment else None,
+                'departure_date': shipment.departure_date if shipment else None,
+                'arrival_date': shipment.arrival_date if shipment else None,
+            })
+        return statuses
+
+    async def aget_train_status(self, train_id):
+        # same cache entry as the sync read, loaded with the async orm on a miss
+        return await self.status_cache.aget_train_status(train_id, lambda: self._aload_train_status(train_id))
+
+    async def _aload_train_status(self, train_id):
+        status = {
+            'line': None,
+            'departure_date': None,
+            'parcels': [],
+        }
+        try:
+            shipment = await Shipment.objects.aget(train__id=train_id)
+        except Shipment.DoesNotExist:
+            return status, None
+
+        status['line'] = shipment.line_id
+        status['departure_date'] = shipment.departure_date
+        serializer = self._get_parcels_serializer(shipment)
+        parcels = [parcel async for parcel in serializer.setup_eager_loading(self._get_shipment_parcels(shipment))]
+        status['parcels'] = [dict(parcel) for parcel in serializer(parcels, many=True).data]
+
+        return status, shipment.arrival_date
 
     def ship_train(self, train, line, optimized_cost_per_weight=None):
         if line not in train.lines.all():
             raise LineNotValidException()
-        if line in self.get_unavailable_lines(train):
+        if not self.is_line_available(line):
             raise LineNotAvailableException()
 
-        parcels = self.parcel_service.get_parcels_to_fill_capacity(train.capacity)
-        if not parcels:
-            raise NoParcelsToLoadException()
+        with transaction.atomic():
+            # one dispatcher per line at a time; the index may not know about other processes yet
+            Line.objects.select_for_update().get(pk=line.id)
+            if self._is_line_busy(line):
+                raise LineNotAvailableException()
 
-        self._book_train(train)
-        self._fill_train(train, line, parcels, optimized_cost_per_weight=None)
-        return  self._send_train(train, line)
+            train = self._book_train(train)
+            parcels = self.parcel_service.get_parcels_to_fill_capacity(train.capacity, lock=True)
+            if not parcels:
+                raise NoParcelsToLoadException()
+
+            self._fill_train(train, line, parcels, optimized_cost_per_weight=optimized_cost_per_weight)
+            return  self._send_train(train, line)
+
+    def _is_line_busy(self, line):
+        utc_now = datetime.now(timezone.utc)
+        return Shipment.objects.filter(line_id=line.id, arrival_date__gt=utc_now).exists()
 
     def _book_train(self, train):
+        # book the locked row, a stale instance could have been booked or withdrawn meanwhile
+        train = Train.objects.select_for_update().get(pk=train.id)
         train.book()
         train.save()
         return train
 
     @transaction.atomic
     def _fill_train(self, train, line, parcels, optimized_cost_per_weight=None):
+        # capacity is checked in memory before anything is written
+        weight_load = sum([parcel.weight for parcel in parcels])
+        volume_load = sum([parcel.volume for parcel in parcels])
+        if weight_load > train.weight_capacity or volume_load > train.volume_capacity:
+            raise FailedToLoadParcelsException()
+
         train.shipment = Shipment(train=train, line=line)
         if optimized_cost_per_weight:
-            train.shipment = optimized_cost_per_weight
+            train.shipment.optimized_cost_per_weight = float(optimized_cost_per_weight)
+        self._cost_parcels(train.shipment, parcels, weight_load)
+        train.shipment.total_weight = weight_load
+        train.shipment.total_volume = volume_load
+        train.shipment.total_revenue = sum([parcel.cost for parcel in parcels])
         train.shipment.save()
-        weight_load, volume_load = (0, 0)
+
         for parcel in parcels:
-            weight_load += parcel.weight
-            volume_load += parcel.volume
             parcel.shipment = train.shipment
-
-            if weight_load > train.weight_capacity or volume_load > train.volume_capacity:
-                raise FailedToLoadParcelsException()
-
-            parcel.save()
-            train.shipment.parcels.add(parcel)
-
+        Parcel.objects.bulk_update(parcels, ['shipment', 'cost'], batch_size=self.bulk_chunk_size)
+        self.parcel_service.backlog.remove(parcels)
+        ShipmentParcel.objects.bulk_create(
+            [ShipmentParcel(shipment=train.shipment, porcel=parcel) for parcel in parcels],
+            batch_size=self.bulk_chunk_size
+        )
+        self.status_cache.invalidate_parcels([parcel.id for parcel in parcels])
+        self.status_cache.invalidate_trains([train.id])
         return True
 
     def _send_train(self, train, line):
-        self.set_parcel_costs(train.shipment)
         train.shipment.departure_date = datetime.now(timezone.utc)
         train.shipment.arrival_date = train.shipment.departure_date  + timedelta(hours=settings.TRAIN_TRAVEL_TIME_HRS)
         train.shipment.save()
+        # only once committed, a rolled back shipment must not keep the line busy in this process
+        arrival_date = train.shipment.arrival_date
+        transaction.on_commit(lambda: self.line_availability.mark_busy(line.id, arrival_date))
+        # the train is booked and its parcels are gone from the backlog
+        self.solve_cache.invalidate()
         return train.shipment
 
+    def _cost_parcels(self, shipment, parcels, weight):
+        cost_per_weight = shipment.optimized_cost_per_weight or (shipment.train.cost / weight)
+        for parcel in parcels:
+            parcel.cost = round(parcel.weight * cost_per_weight * (1 + self.profit_margin_percentage), 2)
+
     @transaction.atomic
     def set_parcel_costs(self, shipment):
-        cost_per_weight = shipment.optimized_cost_per_weight or (shipment.train.cost / shipment.weight)
-        for parcel in shipment.parcels.all():
-            parcel.cost = round(parcel.weight * cost_per_weight * (1 + self.profit_margin_percentage), 2)
-            parcel.save()
+        parcels = list(shipment.parcels.all())
+        self._cost_parcels(shipment, parcels, sum([parcel.weight for parcel in parcels]))
+        Parcel.objects.bulk_update(parcels, ['cost'], batch_size=self.bulk_chunk_size)
+
+        shipment.total_revenue = sum([parcel.cost for parcel in parcels])
+        shipment.save(update_fields=['total_revenue'])
+        self.status_cache.invalidate_parcels([parcel.id for parcel in parcels])
+        self.status_cache.invalidate_trains([shipment.train_id])
+
+    def get_inconsistent_shipments(self):
+        # shipments whose stored totals drifted from their parcels, archived ones are summed from the archive
+        live = Shipment.objects.filter(archived_at=None).annotate(
+            parcels_weight=Sum('parcels__weight'),
+            parcels_volume=Sum('parcels__volume'),
+            parcels_revenue=Sum('parcels__cost'),
+        )
+        archived = Shipment.objects.exclude(archived_at=None).annotate(
+            parcels_weight=Sum('archived_parcels__weight'),
+            parcels_volume=Sum('archived_parcels__volume'),
+            parcels_revenue=Sum('archived_parcels__cost'),
+        )
+        return [
+            shipment for shipments in [live, archived] for shipment in shipments.iterator(chunk_size=self.bulk_chunk_size)
+            if not self._is_close(shipment.total_weight, shipment.parcels_weight)
+                or not self._is_close(shipment.total_volume, shipment.parcels_volume)
+                or not self._is_close(shipment.total_revenue, shipment.parcels_revenue)
+        ]
+
+    @transaction.atomic
+    def fix_shipment_totals(self, shipments):
+        for shipment in shipments:
+            shipment.total_weight = shipment.parcels_weight or 0
+            shipment.total_volume = shipment.parcels_volume or 0
+            shipment.total_revenue = shipment.parcels_revenue or 0
+        Shipment.objects.bulk_update(shipments, ['total_weight', 'total_volume', 'total_revenue'], batch_size=self.bulk_chunk_size)
+        return shipments
+
+    def _is_close(self, stored, actual):
+        return math.isclose(stored, actual or 0, rel_tol=1e-9, abs_tol=1e-6)
 
-    """ TO DO: may be out of scope
     def schedule_shipments(self, **args):
-        lines = Line.objects.all()
-        trains = self.train_operator_service.get_available_trains()
-        total_capacity = (trains.aggregate(Sum('weight_capacity')), trains.aggregate(Sum('volume_capacity')))
-        parcels = self.parcel_service.get_parcels_within_capacity(total_capacity)
-        cost, schedule = optimizer_service.minimize_cost(lines, trains, parcels)
+        dry_run = bool(args.get('dry_run', False))
+        multi_shift = bool(args.get('multi_shift', False))
+        utc_now = datetime.now(timezone.utc)
+        plan = {
+            'dry_run': dry_run,
+            'multi_shift': multi_shift,
+            'status': None,
+            'total_cost': None,
+            'cost_per_weight': None,
+            'trains': [],
+        }
+
+        trains = list(self.train_service.get_available_trains())
+        if not trains:
+            return plan
+
+        # only parcels some open train can carry are worth planning for
+        capacity = (max([train.weight_capacity for train in trains]), max([train.volume_capacity for train in trains]))
+        parcels = self.parcel_service.get_parcels_within_capacity(capacity)
+        _, parcel_weight, parcel_volume = self.parcel_service.backlog.get_load_within(capacity)
+        if multi_shift:
+            # one solve lays out the day's departures, shift by shift
+            line_available_at = {
+                line_id: self.line_availability.get_available_at(line_id, at=utc_now)
+                for line_id in self.line_availability.get_unavailable_lines(at=utc_now)
+            }
+            result = self.optimizer_service.minimize_cost_timetable(Line.objects.all(), trains, parcels, start=utc_now, line_available_at=line_available_at, parcel_load=(parcel_weight, parcel_volume))
+        else:
+            result = self.optimizer_service.minimize_cost(Line.objects.all(), trains, parcels, parcel_load=(parcel_weight, parcel_volume))
+        plan['status'] = result.status
+        if not result.schedule:
+            return plan
+
+        plan['total_cost'] = result.cost
+        plan['cost_per_weight'] = result.cost / parcel_weight if parcel_weight else None
+
+        timetable = result.schedule if multi_shift else self._get_timetable(result.schedule, utc_now)
+        for train, line_id, departure_date in timetable:
+            plan['trains'].append({
+                'train': train.id,
+                'line': line_id,
+                'cost': train.cost,
+                'departure_date': departure_date,
+                'dispatch': departure_date <= utc_now,
+                'shipment': None,
+                'parcels': 0,
+                'weight': 0,
+                'volume': 0,
+                'error': None,
+            })
+
+        dispatchable = [(entry, train) for entry, (train, _, _) in zip(plan['trains'], timetable) if entry['dispatch']]
+        if dry_run:
+            loads = self.parcel_service.get_parcels_to_fill_capacities([train.capacity for entry, train in dispatchable])
+            for (entry, train), load in zip(dispatchable, loads):
+                self._set_planned_load(entry, len(load), sum([p.weight for p in load]), sum([p.volume for p in load]))
+            return plan
+
+        lines = Line.objects.in_bulk([entry['line'] for entry, train in dispatchable])
+        with transaction.atomic():
+            for entry, train in dispatchable:
+                try:
+                    shipment = self.ship_train(train, lines[entry['line']], optimized_cost_per_weight=plan['cost_per_weight'])
+                except (LineNotAvailableException, NoParcelsToLoadException, FailedToLoadParcelsException, TransitionNotAllowed) as e:
+                    entry['error'] = str(e)
+                    continue
+
+                entry['shipment'] = shipment.id
+                self._set_planned_load(entry, ShipmentParcel.objects.filter(shipment=shipment).count(), shipment.weight, shipment.volume)
+
+        return plan
 
-        earliest_departure_date = args.get('earliest_departure_date', datetime.now(timezone.utc) + timedelta(hours=settings.TRAIN_TRAVEL_TIME_HRS))
-    """
+    def _get_timetable(self, schedule, utc_now):
+        # trains whose line frees up first go first; a line takes one departure per travel window
+        entries = sorted(
+            [(self.line_availability.get_available_at(line_id, at=utc_now), train.cost, train, line_id) for train, line_id in schedule],
+            key=lambda entry: (entry[0], entry[1], entry[2].id)
+        )
+        timetable, line_free_at = [], {}
+        for available_at, _, train, line_id in entries:
+            departure_date = max(available_at, line_free_at.get(line_id, available_at))
+            line_free_at[line_id] = departure_date + timedelta(hours=settings.TRAIN_TRAVEL_TIME_HRS)
+            timetable.append((train, line_id, departure_date))
+        return timetable
 
+    def _set_planned_load(self, entry, parcels, weight, volume):
+        entry['parcels'] = parcels
+        entry['weight'] = weight
+        entry['volume'] = volume
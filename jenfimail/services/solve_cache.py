@@ -0,0 +1,72 @@
+from django.db import transaction
+
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+import numpy as np
+
+class SolveCache():
+    """ Process-local LRU of solved schedules keyed by a fingerprint of the problem, so repeated solves skip the solver. """
+
+    def __init__(self, **args):
+        self.max_size = int(args.get('max_size', 128))
+        # entries also expire, other processes mutate trains and parcels without telling this one
+        self.ttl_secs = float(args.get('ttl_secs', 300))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def fingerprint(self, problem, *config):
+        digest = hashlib.sha256()
+        for array in [problem.train_ids, problem.costs, problem.weight_capacities, problem.volume_capacities,
+                      problem.line_ids, problem.pair_trains, problem.pair_lines]:
+            digest.update(np.ascontiguousarray(array).tobytes())
+            digest.update(b'|')
+        digest.update(repr((float(problem.parcel_weight), float(problem.parcel_volume)) + config).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_secs:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.clear()
+        # a solve racing the open transaction can store a schedule of the old data, so drop it again once committed
+        transaction.on_commit(self.clear)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def reset(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return { 'size': len(self.entries), 'hits': self.hits, 'misses': self.misses }
+
+solve_cache = SolveCache()
@@ -0,0 +1,161 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+import threading
+import time
+
+class LocalStatusCacheBackend():
+    """ In-process LRU; mutations in other processes only reach it through the TTL. """
+
+    def __init__(self, **args):
+        self.max_size = int(args.get('max_size', 10000))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    async def aget(self, key):
+        # a dict lookup under a short lock, fine on the event loop
+        return self.get(key)
+
+    async def aset(self, key, value, timeout):
+        self.set(key, value, timeout)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() >= entry[0]:
+                del self.entries[key]
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class DjangoStatusCacheBackend():
+    """ Any CACHES alias, e.g. redis or memcached shared by every worker. """
+
+    def __init__(self, **args):
+        self.alias = args.get('alias', 'default')
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value, timeout):
+        await self.cache.aset(key, value, timeout)
+
+    def delete_many(self, keys):
+        self.cache.delete_many(keys)
+
+    def clear(self):
+        self.cache.clear()
+
+class StatusCache():
+    """ Read-through cache of serialized parcel and train statuses. """
+
+    BACKEND_LOCAL = 'local'
+    BACKEND_DJANGO = 'django'
+
+    PARCEL_KEY = 'jenfimail:parcel-status:{}'
+    TRAIN_KEY = 'jenfimail:train-status:{}'
+
+    def __init__(self, **args):
+        self.backend = args.get('backend') or LocalStatusCacheBackend()
+        self.ttl_secs = float(args.get('ttl_secs', 60))
+
+    def get_parcel_status(self, parcel_id, load):
+        return self.read_through(self.PARCEL_KEY.format(parcel_id), load)
+
+    def get_train_status(self, train_id, load):
+        return self.read_through(self.TRAIN_KEY.format(train_id), load)
+
+    async def aget_parcel_status(self, parcel_id, aload):
+        return await self.aread_through(self.PARCEL_KEY.format(parcel_id), aload)
+
+    async def aget_train_status(self, train_id, aload):
+        return await self.aread_through(self.TRAIN_KEY.format(train_id), aload)
+
+    def read_through(self, key, load):
+        # load returns the status and the arrival_date that flips it, if any
+        utc_now = datetime.now(timezone.utc)
+        entry = self.backend.get(key)
+        if self.is_fresh(entry, utc_now):
+            return entry[1]
+
+        value, arrival_date = load()
+        expires_at, timeout = self.get_expiry(arrival_date, utc_now)
+        self.backend.set(key, (expires_at, value), timeout)
+        return value
+
+    async def aread_through(self, key, aload):
+        # same entries as read_through, aload is a coroutine function
+        utc_now = datetime.now(timezone.utc)
+        entry = await self.backend.aget(key)
+        if self.is_fresh(entry, utc_now):
+            return entry[1]
+
+        value, arrival_date = await aload()
+        expires_at, timeout = self.get_expiry(arrival_date, utc_now)
+        await self.backend.aset(key, (expires_at, value), timeout)
+        return value
+
+    def is_fresh(self, entry, utc_now):
+        # the expiry is also checked on read, backends may round the timeout to whole seconds
+        return entry is not None and (entry[0] is None or utc_now < entry[0])
+
+    def get_expiry(self, arrival_date, utc_now):
+        expires_at = arrival_date if arrival_date and arrival_date > utc_now else None
+        timeout = min(self.ttl_secs, (expires_at - utc_now).total_seconds()) if expires_at else self.ttl_secs
+        return expires_at, timeout
+
+    def invalidate_parcels(self, parcel_ids):
+        self.invalidate([self.PARCEL_KEY.format(parcel_id) for parcel_id in parcel_ids])
+
+    def invalidate_trains(self, train_ids):
+        self.invalidate([self.TRAIN_KEY.format(train_id) for train_id in train_ids])
+
+    def invalidate(self, keys):
+        self.backend.delete_many(keys)
+        # a read racing the open transaction can put the old status back, so drop it again once committed
+        transaction.on_commit(lambda: self.backend.delete_many(keys))
+
+    def clear(self):
+        self.backend.clear()
+
+def get_status_cache_backend():
+    if getattr(settings, 'STATUS_CACHE_BACKEND', StatusCache.BACKEND_LOCAL) == StatusCache.BACKEND_DJANGO:
+        return DjangoStatusCacheBackend(alias=getattr(settings, 'STATUS_CACHE_ALIAS', 'default'))
+    return LocalStatusCacheBackend(max_size=getattr(settings, 'STATUS_CACHE_MAX_SIZE', 10000))
+
+status_cache = StatusCache(
+    backend=get_status_cache_backend(),
+    ttl_secs=getattr(settings, 'STATUS_CACHE_TTL_SECS', 60)
+)
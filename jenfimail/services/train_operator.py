@@ -1,7 +1,14 @@
+from django.db import transaction
+
 from ..models import Train, Line
 from ..custom_exceptions import LinesNotFoundException
+from .solve_cache import solve_cache
+from ..instrumentation import instrumented, uninstrumented
 
+@instrumented
 class TrainOperatorService():
+    def __init__(self, **args):
+        self.solve_cache = args.get('solve_cache', solve_cache)
 
     def bid_train(self, data):
         line_ids = data.get('lines', [])
@@ -15,18 +22,22 @@ class TrainOperatorService():
         train.volume_capacity = float(data.get('volume_capacity'))
         train.save()
         train.lines.set(lines)
+        self.solve_cache.invalidate()
 
         return train
 
+    @transaction.atomic
     def withdraw_train(self, train_id):
-        train = Train.objects.get(pk=train_id)
+        train = Train.objects.select_for_update().get(pk=train_id)
         if not train:
             raise LinesNotFoundException()
 
         train.withdraw()
         train.save()
+        self.solve_cache.invalidate()
         return train
 
+    @uninstrumented
     def get_available_trains(self):
         return Train.objects.filter(status=Train.STATUS_OPEN).all()
 
@@ -0,0 +1,4 @@
+from ..instrumentation import instrumentation
+
+# no sampled call logs in the test output, tests that look at them sample on their own
+instrumentation.sample_rate = 0
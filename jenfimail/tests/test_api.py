@@ -1,10 +1,18 @@
+import csv
+import io
+import json
+
 from django.test import TestCase
+from django.core.serializers.json import DjangoJSONEncoder
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from rest_framework.test import APIRequestFactory, RequestsClient
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from ..services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService
+from ..services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService, line_availability_index, status_cache
+from ..instrumentation import instrumentation
 from ..models import Train, Line, Parcel
 from ..views import LineView, TrainView, ParcelView
 
@@ -22,6 +30,8 @@ parcel_view = ParcelView.as_view()
 class APITest(TestCase):
 
     def setUp(self):
+        line_availability_index.invalidate()
+        status_cache.clear()
         self.line_a = post_master_service.create_line({ 'name': 'A' })
         self.line_b = post_master_service.create_line({ 'name': 'B' })
         self.line_c = post_master_service.create_line({ 'name': 'C' })
@@ -87,6 +97,101 @@ class APITest(TestCase):
         self.assertTrue(status.is_success(response.status_code))
         self.assertTrue(response.data.get('id'))
 
+    def test_rest_list_query_budget(self):
+        def count_queries(view, url):
+            with CaptureQueriesContext(connection) as queries:
+                response = view(factory.get(url))
+            self.assertTrue(status.is_success(response.status_code))
+            return len(queries.captured_queries)
+
+        before = {
+            'lines/': count_queries(line_view, 'lines/'),
+            'trains/': count_queries(train_view, 'trains/'),
+            'parcels/': count_queries(parcel_view, 'parcels/'),
+        }
+
+        post_master_service.ship_train(self.train_james, self.line_c)
+        post_master_service.create_line({ 'name': 'D' })
+        train_operator_service.bid_train({
+            'name': 'Gordon',
+            'weight_capacity': 100,
+            'volume_capacity': 100,
+            'cost': 100,
+            'lines': [self.line_a.name, self.line_c.name]
+        })
+        parcel_service.deposit_parcels([{ 'label': 'extra', 'weight': 1, 'volume': 1 } for i in range(10)])
+
+        self.assertEqual(count_queries(line_view, 'lines/'), before['lines/'])
+        self.assertEqual(count_queries(train_view, 'trains/'), before['trains/'])
+        self.assertEqual(count_queries(parcel_view, 'parcels/'), before['parcels/'])
+
+    def test_rest_get_parcels_paginated(self):
+        ids = []
+        response = self.client.get('/parcels/', { 'limit': 3, 'fields': 'id,status' })
+        while True:
+            self.assertTrue(status.is_success(response.status_code))
+            self.assertTrue(len(response.data.get('results')) <= 3)
+            for parcel in response.data.get('results'):
+                self.assertEqual(set(parcel.keys()), { 'id', 'status' })
+                ids.append(parcel.get('id'))
+
+            if not response.data.get('next'):
+                break
+            response = self.client.get(response.data.get('next'))
+
+        self.assertEqual(ids, [parcel.id for parcel in Parcel.objects.order_by('created_at', 'id')])
+
+    def test_rest_get_trains_paginated(self):
+        response = self.client.get('/trains/', { 'limit': 2 })
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual([train.get('id') for train in response.data.get('results')], [self.train_thomas.id, self.train_james.id])
+        self.assertTrue(response.data.get('next'))
+
+        response = self.client.get(response.data.get('next'))
+        self.assertEqual([train.get('id') for train in response.data.get('results')], [self.train_percy.id])
+        self.assertFalse(response.data.get('next'))
+
+        response = self.client.get('/trains/', { 'cursor': 'not-a-cursor' })
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_schedule_shipments_dry_run(self):
+        response = self.client.post('/api/schedule/', { 'dry_run': 'true' })
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertTrue(response.data.get('dry_run'))
+        self.assertTrue(response.data.get('trains'))
+        self.assertEqual(response.data.get('total_cost'), sum([entry.get('cost') for entry in response.data.get('trains')]))
+
+    def test_export_parcels(self):
+        post_master_service.ship_train(self.train_james, self.line_c)
+        parcel_service.withdraw_parcel(self.parcel_big.id)
+
+        response = self.client.get('/api/export/parcels')
+        self.assertTrue(status.is_success(response.status_code))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([row.get('id') for row in rows], [parcel.id for parcel in Parcel.objects.order_by('created_at', 'id')])
+        for row in rows:
+            self.assertEqual(row.get('status'), Parcel.objects.get(pk=row.get('id')).status)
+
+        response = self.client.get('/api/export/parcels', { 'format': 'csv', 'withdrawn_after': '2000-01-01T00:00:00Z' })
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row.get('id')) for row in rows], [self.parcel_big.id])
+        self.assertEqual(rows[0].get('status'), 'withdrawn')
+
+        response = self.client.get('/api/export/parcels', { 'created_after': 'yesterday' })
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_shipments(self):
+        shipment = post_master_service.ship_train(self.train_james, self.line_c)
+
+        response = self.client.get('/api/export/shipments', { 'format': 'csv' })
+        self.assertTrue(status.is_success(response.status_code))
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row.get('id')) for row in rows], [shipment.id])
+        self.assertEqual(float(rows[0].get('total_weight')), shipment.weight)
+
+        response = self.client.get('/api/export/shipments', { 'departure_before': '2000-01-01T00:00:00Z' })
+        self.assertFalse(b''.join(response.streaming_content))
+
     def test_index(self):
         response = self.client.get('/api/')
         self.assertTrue(status.is_success(response.status_code))
@@ -122,6 +227,29 @@ class APITest(TestCase):
         self.assertTrue(status.is_success(response.status_code))
         self.assertTrue(response.data.get('id'))
 
+    def test_deposit_parcels_bulk(self):
+        parcels_data = [
+            { 'label': 'bulk-0001', 'weight': 1, 'volume': 10 },
+            { 'label': 'bulk-0002', 'weight': 'heavy', 'volume': 10 },
+            { 'label': 'bulk-0003', 'weight': 3, 'volume': 30 },
+        ]
+        response = self.client.post('/api/parcels/deposit/bulk/', parcels_data, content_type='application/json')
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(len(response.data.get('ids')), 2)
+        self.assertEqual([error.get('index') for error in response.data.get('errors')], [1])
+        self.assertEqual([parcel.label for parcel in Parcel.objects.filter(pk__in=response.data.get('ids'))], ['bulk-0001', 'bulk-0003'])
+
+    def test_deposit_parcels_bulk_ndjson(self):
+        body = '{"label": "bulk-0001", "weight": 1, "volume": 10}\n{"label": "bulk-0002", "weight": 2, "volume": 20}\n'
+        response = self.client.post('/api/parcels/deposit/bulk/', body, content_type='application/x-ndjson')
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(len(response.data.get('ids')), 2)
+        self.assertFalse(response.data.get('errors'))
+
+    def test_deposit_parcels_bulk_invalid(self):
+        response = self.client.post('/api/parcels/deposit/bulk/', { 'label': 'single' }, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_get_parcel_status(self):
         response = self.client.get('/api/parcels/{parcel_id}/status/'.format(parcel_id=self.parcel_big.id))
         self.assertTrue(status.is_success(response.status_code))
@@ -137,3 +265,73 @@ class APITest(TestCase):
         self.assertTrue(response.data.get('line'))
         self.assertTrue(response.data.get('train'))
         self.assertTrue(len(response.data.get('parcels', [])))
+
+    def test_async_status(self):
+        shipment = post_master_service.ship_train(self.train_thomas, self.train_thomas.lines.first())
+
+        response = self.client.get('/api/async/trains/{train_id}/status/'.format(train_id=self.train_thomas.id))
+        self.assertTrue(status.is_success(response.status_code))
+        self.assertEqual(response.json(), json.loads(json.dumps(post_master_service.get_train_status(self.train_thomas.id), cls=DjangoJSONEncoder)))
+
+        parcel = shipment.parcels.first()
+        response = self.client.get('/api/async/parcels/{parcel_id}/status/'.format(parcel_id=parcel.id))
+        self.assertEqual(response.json(), self.client.get('/api/parcels/{parcel_id}/status/'.format(parcel_id=parcel.id)).json())
+        self.assertEqual(self.client.get('/api/async/parcels/0/status/').status_code, status.HTTP_400_BAD_REQUEST)
+
+    async def test_async_list_paginated(self):
+        response = await self.async_client.get('/async/trains/', { 'limit': 2 })
+        self.assertEqual(len(response.json().get('results')), 2)
+        self.assertTrue(response.json().get('results')[0].get('lines'))
+
+        response = await self.async_client.get(response.json().get('next'))
+        self.assertEqual(len(response.json().get('results')), 1)
+        self.assertFalse(response.json().get('next'))
+
+        response = await self.async_client.get('/async/parcels/', { 'limit': 100, 'fields': 'id,status' })
+        self.assertEqual(set(response.json().get('results')[0].keys()), { 'id', 'status' })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_get_statuses_batch(self):
+        post_master_service.ship_train(self.train_thomas, self.train_thomas.lines.first())
+        parcels = list(Parcel.objects.all())
+        ids = ','.join([str(parcel.id) for parcel in parcels] + ['0'])
+
+        # the unknown id is looked up in the archive as well
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/parcels/status', { 'ids': ids })
+        self.assertEqual(len(response.data.get('results')), len(parcels))
+        self.assertEqual(response.data.get('missing'), [0])
+        statuses = { parcel['id']: parcel['status'] for parcel in response.data.get('results') }
+        for parcel in parcels:
+            self.assertEqual(statuses[parcel.id], parcel.status)
+
+        # a projection without the id still tells the missing ones apart
+        response = self.client.get('/api/parcels/status', { 'ids': ids, 'fields': 'status' })
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data.get('missing'), [0])
+        self.assertEqual(sorted([parcel['status'] for parcel in response.data.get('results')]), sorted([parcel.status for parcel in parcels]))
+        self.assertNotIn('id', response.data.get('results')[0])
+
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/trains/status', { 'ids': [self.train_thomas.id, self.train_james.id] }, content_type='application/json')
+        results = { train['id']: train for train in response.data.get('results') }
+        self.assertEqual(results[self.train_thomas.id]['line'], self.train_thomas.lines.first().id)
+        self.assertEqual(results[self.train_thomas.id]['shipment_status'], 'in transit')
+        self.assertIsNone(results[self.train_james.id]['shipment'])
+
+        self.assertEqual(self.client.get('/api/parcels/status', { 'ids': 'a,b' }).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post('/api/trains/status', {}, content_type='application/json').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_metrics(self):
+        instrumentation.registry.reset()
+        self.client.get('/api/parcels/{}/status/'.format(Parcel.objects.first().id))
+        self.client.get('/api/parcels/0/status/')
+
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        # one series per route, not per parcel id
+        metrics = response.content.decode()
+        self.assertIn('jenfimail_call_duration_seconds_count{kind="request",name="GET api/parcels/<int:parcel_id>/status/"} 2', metrics)
+        self.assertIn('jenfimail_calls_total{kind="service",name="ParcelService.get_parcel_status",status="error"} 1', metrics)
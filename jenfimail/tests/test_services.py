@@ -1,7 +1,23 @@
-from django.test import TestCase
-from ..services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService
-from ..custom_exceptions import LineNotValidException, LineNotAvailableException, LinesNotFoundException, NoParcelsToLoadException
-from ..models import Train, Line, Parcel
+from django.test import TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from django.core.management import call_command
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from pulp import PulpSolverError
+from io import StringIO
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import tempfile
+import threading
+import time
+from ..services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService, PackerService, line_availability_index, solve_cache, status_cache, StatusCache, LocalStatusCacheBackend, DjangoStatusCacheBackend
+from ..custom_exceptions import LineNotValidException, LineNotAvailableException, LinesNotFoundException, NoParcelsToLoadException, SolverNotValidException, SolverOptionNotSupportedException
+from ..bench import BenchDataGenerator
+from ..services.optimizer import OptimizationResult
+from ..instrumentation import instrumentation
+from ..models import Train, Line, Parcel, Shipment, ShipmentParcel, ArchivedParcel, ArchivedShipmentParcel, BacklogSummary, BacklogBucket
 
 train_operator_service = TrainOperatorService()
 parcel_service = ParcelService()
@@ -11,6 +27,7 @@ post_master_service = PostMasterService(train_operator_service, parcel_service,
 class PostMasterServiceTest(TestCase):
 
     def setUp(self):
+        line_availability_index.invalidate()
         self.line_a = post_master_service.create_line({ 'name': 'A' })
         self.line_b = post_master_service.create_line({ 'name': 'B' })
         self.line_c = post_master_service.create_line({ 'name': 'C' })
@@ -41,6 +58,7 @@ class TrainOpearatorServiceTest(TestCase):
     STATUS_FILLED = 'filled'
 
     def setUp(self):
+        line_availability_index.invalidate()
         self.line_a = post_master_service.create_line({ 'name': 'A' })
         self.line_b = post_master_service.create_line({ 'name': 'B' })
         self.line_c = post_master_service.create_line({ 'name': 'C' })
@@ -171,6 +189,31 @@ class ParcelOwnerServiceTest(TestCase):
         self.assertTrue(parcel_service.is_fillable(self.max_load))
         self.assertTrue(parcel_service.is_fillable(self.min_load))
 
+    def test_get_parcels_to_fill_capacity_zero(self):
+        self.assertFalse(parcel_service.get_parcels_to_fill_capacity(self.zero_load))
+        self.assertFalse(parcel_service.get_parcels_to_fill_capacity(self.zero_weight_load))
+        self.assertFalse(parcel_service.get_parcels_to_fill_capacity(self.zero_volume_load))
+
+    def test_get_parcels_to_fill_capacity_fifo(self):
+        with self.assertNumQueries(1):
+            parcels = parcel_service.get_parcels_to_fill_capacity((10, 100))
+        self.assertEqual([parcel.id for parcel in parcels], [self.parcel1.id, self.parcel2.id])
+
+        with self.assertNumQueries(1):
+            parcels = parcel_service.get_parcels_to_fill_capacity((35, 230))
+        self.assertEqual([parcel.id for parcel in parcels], [self.parcel1.id, self.parcel2.id])
+
+    def test_get_parcels_to_fill_capacity_density(self):
+        parcels = parcel_service.get_parcels_to_fill_capacity((35, 230), strategy=PackerService.STRATEGY_DENSITY)
+        self.assertEqual([parcel.id for parcel in parcels], [self.parcel1.id, self.parcel3.id])
+
+    def test_get_parcels_to_fill_capacity_exact(self):
+        parcels = parcel_service.get_parcels_to_fill_capacity((35, 260), strategy=PackerService.STRATEGY_EXACT)
+        self.assertEqual([parcel.id for parcel in parcels], [self.parcel2.id, self.parcel3.id])
+
+        parcels = parcel_service.get_parcels_to_fill_capacity((35, 260))
+        self.assertEqual([parcel.id for parcel in parcels], [self.parcel1.id, self.parcel2.id])
+
     """
     def test_get_parcels_for_filling_zero(self):
         self.assertFalse(parcel_service.get_parcels_for_filling(self.zero_load))
@@ -188,6 +231,9 @@ class PostMasterServiceTest(TestCase):
     PARCEL_STATUS_IN_TRANSIT = 'in transit'
 
     def setUp(self):
+        line_availability_index.invalidate()
+        solve_cache.reset()
+        status_cache.clear()
         self.line_a = post_master_service.create_line({ 'name': 'A' })
         self.line_b = post_master_service.create_line({ 'name': 'B' })
         self.line_c = post_master_service.create_line({ 'name': 'C' })
@@ -235,6 +281,25 @@ class PostMasterServiceTest(TestCase):
         shipment = post_master_service.ship_train(self.train_thomas, self.line_b)
         self.assertRaises(LineNotAvailableException, post_master_service.ship_train, self.train_percy, self.line_b)
 
+    def test_line_availability_index(self):
+        # a shipment that is rolled back leaves the line free
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                post_master_service.ship_train(self.train_thomas, self.line_b)
+                transaction.set_rollback(True)
+        self.assertTrue(post_master_service.is_line_available(self.line_b))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            shipment = post_master_service.ship_train(self.train_thomas, self.line_b)
+        with self.assertNumQueries(0):
+            self.assertFalse(post_master_service.is_line_available(self.line_b))
+            self.assertTrue(post_master_service.is_line_available(self.line_a))
+            self.assertEqual(post_master_service.get_unavailable_lines(), { self.line_b.id })
+            self.assertTrue(line_availability_index.is_available(self.line_b.id, at=shipment.arrival_date))
+
+        line_availability_index.invalidate()
+        self.assertFalse(post_master_service.is_line_available(self.line_b))
+
     def test_ship_train_normal(self):
         shipment = post_master_service.ship_train(self.train_thomas, self.train_thomas.lines.first())
         self.assertTrue(shipment)
@@ -264,6 +329,49 @@ class PostMasterServiceTest(TestCase):
         self.assertEqual(len(shipment.parcels.all()), 4)
         self.assertEqual(self.train_james.cost, shipment.revenue)
 
+    def test_fill_train_bulk_queries(self):
+        parcels = parcel_service.get_parcels_to_fill_capacity(self.train_james.capacity)
+        with CaptureQueriesContext(connection) as few_parcels:
+            post_master_service._fill_train(self.train_james, self.line_c, parcels)
+
+        parcel_service.deposit_parcels([{ 'label': 'tiny', 'weight': 0.01, 'volume': 0.01 } for i in range(200)])
+        train = train_operator_service.bid_train({
+            'name': 'Gordon (Big)',
+            'weight_capacity': 200,
+            'volume_capacity': 500,
+            'cost': 400,
+            'lines': [self.line_a.name]
+        })
+        parcels = parcel_service.get_parcels_to_fill_capacity(train.capacity)
+        with CaptureQueriesContext(connection) as many_parcels:
+            post_master_service._fill_train(train, self.line_a, parcels)
+
+        self.assertTrue(len(train.shipment.parcels.all()) >= 200)
+        self.assertEqual(len(few_parcels.captured_queries), len(many_parcels.captured_queries))
+
+    def test_ship_train_optimized_cost_per_weight(self):
+        shipment = post_master_service.ship_train(self.train_james, self.train_james.lines.first(), 1.5)
+        self.assertEqual(shipment.optimized_cost_per_weight, 1.5)
+        for parcel in shipment.parcels.all():
+            self.assertEqual(parcel.cost, round(parcel.weight * 1.5, 2))
+
+    def test_shipment_totals(self):
+        shipment = post_master_service.ship_train(self.train_james, self.train_james.lines.first())
+        parcels = list(shipment.parcels.all())
+        with self.assertNumQueries(0):
+            self.assertEqual(shipment.weight, sum([parcel.weight for parcel in parcels]))
+            self.assertEqual(shipment.volume, sum([parcel.volume for parcel in parcels]))
+            self.assertEqual(shipment.revenue, sum([parcel.cost for parcel in parcels]))
+        self.assertFalse(post_master_service.get_inconsistent_shipments())
+
+        Shipment.objects.filter(pk=shipment.id).update(total_weight=0)
+        inconsistent = post_master_service.get_inconsistent_shipments()
+        self.assertEqual([s.id for s in inconsistent], [shipment.id])
+
+        call_command('check_shipment_totals', '--fix', stdout=StringIO())
+        self.assertFalse(post_master_service.get_inconsistent_shipments())
+        self.assertEqual(Shipment.objects.get(pk=shipment.id).weight, shipment.weight)
+
     def test_ship_train_small(self):
         self.assertRaises(NoParcelsToLoadException, post_master_service.ship_train, self.train_percy, self.train_percy.lines.first())
 
@@ -288,6 +396,388 @@ class PostMasterServiceTest(TestCase):
         self.assertTrue(sum([p.weight for p in parcels]) <= calculated_weight)
         self.assertTrue(sum([p.volume for p in parcels]) <= calculated_volume)
 
+    def test_optimize_solver_diagnostics(self):
+        trains = Train.objects.all()
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+
+        result = OptimizerService(time_limit=10, mip_gap=0.01).minimize_cost(lines, trains, parcels)
+        self.assertEqual(result.status, 'Optimal')
+        # the gap cbc reached, which can only be tighter than the one asked for
+        self.assertTrue(0 <= result.gap <= 0.01)
+        self.assertTrue(result.wall_time >= 0)
+        self.assertEqual(result.cost, sum([train.cost for train, line in result.schedule]))
+
+    def test_optimize_time_limit_status(self):
+        optimizer = OptimizerService()
+        # pulp hands back status 1 for a stop on the time limit that found a schedule
+        self.assertEqual(optimizer.get_status(1, 2), OptimizerService.STATUS_NOT_OPTIMAL)
+        self.assertEqual(optimizer.get_status(1, 1), 'Optimal')
+        self.assertEqual(optimizer.get_status(-1, -1), 'Infeasible')
+
+        log_path = os.path.join(tempfile.gettempdir(), 'jenfimail-test-cbc.log')
+        with open(log_path, 'w') as log:
+            log.write('Result - Stopped on time limit\n\nObjective value:                1000.00000000\nLower bound:                    950.000\nGap:                            0.05\n')
+        self.assertAlmostEqual(optimizer.read_gap(log_path), 0.05)
+        os.remove(log_path)
+        self.assertIsNone(optimizer.read_gap(log_path))
+
+        # the log goes away even when the solve itself fails
+        class FailingModel():
+            def solve(self, solver):
+                with open(solver.optionsDict['logPath'], 'w') as log:
+                    log.write('Result - Stopped on signal\n')
+                raise PulpSolverError('killed')
+        solver = optimizer.get_solver()
+        self.assertRaises(PulpSolverError, optimizer.run_model, FailingModel(), [], [], solver=solver)
+        self.assertFalse(os.path.exists(solver.optionsDict['logPath']))
+
+        # HiGHS_CMD has no relative gap switch
+        self.assertRaises(SolverOptionNotSupportedException, OptimizerService, solver=OptimizerService.SOLVER_HIGHS, mip_gap=0.01)
+
+    def test_optimize_greedy(self):
+        trains = Train.objects.all()
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+
+        cost, schedule = OptimizerService(solver=OptimizerService.SOLVER_GREEDY).minimize_cost(lines, trains, parcels)
+        self.assertTrue(schedule)
+        self.assertEqual(cost, sum([train.cost for train, line in schedule]))
+        self.assertTrue(sum([p.weight for p in parcels]) <= sum([train.weight_capacity for train, line in schedule]))
+        self.assertTrue(sum([p.volume for p in parcels]) <= sum([train.volume_capacity for train, line in schedule]))
+        for train, line in schedule:
+            self.assertIn(line, [l.id for l in train.lines.all()])
+
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)
+        cost, schedule = OptimizerService(solver=OptimizerService.SOLVER_GREEDY).minimize_cost(lines, trains, parcels)
+        self.assertFalse(cost)
+        self.assertFalse(schedule)
+
+    def test_optimize_cache(self):
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+
+        cost, schedule = optimizer_service.minimize_cost(lines, train_operator_service.get_available_trains(), parcels)
+        cached_cost, cached_schedule = optimizer_service.minimize_cost(lines, train_operator_service.get_available_trains(), parcels)
+        self.assertEqual(solve_cache.stats(), { 'size': 1, 'hits': 1, 'misses': 1 })
+        self.assertEqual(cached_cost, cost)
+        self.assertEqual([(train.id, line) for train, line in cached_schedule], [(train.id, line) for train, line in schedule])
+
+        # other solver settings are a different problem
+        OptimizerService(solver=OptimizerService.SOLVER_GREEDY).minimize_cost(lines, Train.objects.all(), parcels)
+        self.assertEqual(solve_cache.stats()['misses'], 2)
+        OptimizerService(cache=None).minimize_cost(lines, Train.objects.all(), parcels)
+        self.assertEqual(solve_cache.stats()['misses'], 2)
+
+        # a schedule the solver stopped on without proving it is solved again next time
+        solve_cache.reset()
+        unproven = OptimizerService()
+        unproven.solve_problem = lambda problem: OptimizationResult(cost, schedule, OptimizerService.STATUS_NOT_OPTIMAL)
+        unproven.minimize_cost(lines, train_operator_service.get_available_trains(), parcels)
+        self.assertEqual(solve_cache.stats()['size'], 0)
+
+        optimizer_service.minimize_cost(lines, train_operator_service.get_available_trains(), parcels)
+        parcel_service.deposit_parcel({ 'label': 'small-0004', 'weight': 1, 'volume': 1 })
+        self.assertEqual(solve_cache.stats()['size'], 0)
+        optimizer_service.minimize_cost(lines, train_operator_service.get_available_trains(), parcels)
+        train_operator_service.withdraw_train(self.train_percy.id)
+        self.assertEqual(solve_cache.stats()['size'], 0)
+
+    def test_backlog_summary(self):
+        backlog = parcel_service.backlog
+
+        def assert_matches_parcels():
+            pending = Parcel.objects.filter(shipment=None, withdrawn_at=None)
+            summary = backlog.get_summary()
+            self.assertEqual(summary.count, pending.count())
+            self.assertAlmostEqual(summary.total_weight, sum([p.weight for p in pending]))
+            self.assertAlmostEqual(summary.total_volume, sum([p.volume for p in pending]))
+            self.assertEqual(summary.min_weight, min([p.weight for p in pending]))
+            self.assertEqual(summary.min_volume, min([p.volume for p in pending]))
+
+            for capacity in [(1, 1), (2, 30), (10, 100), (50, 119), (80, 300), (200, 500), (1000, 1000)]:
+                fitting = parcel_service.get_parcels_within_capacity(capacity)
+                self.assertEqual(backlog.has_parcels_within(capacity), fitting.exists())
+                count, weight, volume = backlog.get_load_within(capacity)
+                self.assertEqual(count, fitting.count())
+                self.assertAlmostEqual(weight, sum([p.weight for p in fitting]))
+                self.assertAlmostEqual(volume, sum([p.volume for p in fitting]))
+
+        assert_matches_parcels()
+        post_master_service.ship_train(self.train_thomas, self.train_thomas.lines.first())
+        parcel_service.withdraw_parcel(self.parcel_big2.id)
+        assert_matches_parcels()
+
+        # the histogram answers on its own when a whole cell fits
+        with self.assertNumQueries(2):
+            self.assertTrue(parcel_service.is_fillable((200, 500)))
+
+        backlog.rebuild()
+        assert_matches_parcels()
+
+        # flushed tables are rebuilt before the fit checks read them
+        BacklogSummary.objects.all().delete()
+        BacklogBucket.objects.all().delete()
+        self.assertTrue(parcel_service.is_fillable((200, 500)))
+        assert_matches_parcels()
+
+        BacklogSummary.objects.update(count=0)
+        stdout = StringIO()
+        call_command('check_backlog', stdout=stdout)
+        self.assertIn('out of step', stdout.getvalue())
+        call_command('check_backlog', '--fix', stdout=StringIO())
+        assert_matches_parcels()
+
+    def test_archive_parcels(self):
+        shipment = post_master_service.ship_train(self.train_thomas, self.train_thomas.lines.first())
+        shipped = list(shipment.parcels.all())
+        parcel_service.withdraw_parcel(self.parcel_big2.id)
+        summary = parcel_service.backlog.get_summary()
+
+        # an in transit shipment stays where it is
+        call_command('archive_parcels', '--max-batches', '1', stdout=StringIO())
+        self.assertTrue(Parcel.objects.filter(shipment=shipment).exists())
+        self.assertFalse(Parcel.objects.filter(id=self.parcel_big2.id).exists())
+
+        Shipment.objects.filter(pk=shipment.id).update(arrival_date=datetime.now(timezone.utc) - timedelta(hours=1))
+        call_command('archive_parcels', stdout=StringIO())
+        call_command('archive_parcels', stdout=StringIO())
+
+        self.assertFalse(Parcel.objects.exclude(shipment=None, withdrawn_at=None).exists())
+        self.assertEqual(ArchivedParcel.objects.count(), len(shipped) + 2)
+        self.assertEqual(ArchivedShipmentParcel.objects.filter(shipment=shipment).count(), len(shipped))
+        self.assertFalse(ShipmentParcel.objects.filter(shipment=shipment).exists())
+        self.assertIsNotNone(Shipment.objects.get(pk=shipment.id).archived_at)
+
+        status_cache.clear()
+        self.assertEqual(parcel_service.get_parcel_status(shipped[0].id)['status'], Parcel.STATUS_SHIPPED)
+        self.assertEqual(parcel_service.get_parcel_status(self.parcel_big2.id)['status'], Parcel.STATUS_WITHDRAWN)
+        self.assertRaises(Parcel.DoesNotExist, parcel_service.get_parcel_status, 0)
+
+        train_status = post_master_service.get_train_status(self.train_thomas.id)
+        self.assertEqual(sorted([parcel['id'] for parcel in train_status['parcels']]), sorted([parcel.id for parcel in shipped]))
+        self.assertEqual(post_master_service.get_inconsistent_shipments(), [])
+
+        # only finished parcels moved, the backlog is untouched
+        self.assertEqual(parcel_service.backlog.get_summary().count, summary.count)
+
+    def test_instrumentation(self):
+        sample_rate = instrumentation.sample_rate
+        instrumentation.registry.reset()
+        try:
+            instrumentation.sample_rate = 0
+            with self.assertNoLogs('jenfimail.instrumentation'):
+                parcel_service.is_fillable((10, 100))
+
+            line = self.train_thomas.lines.first()
+            instrumentation.sample_rate = 1
+            with self.assertLogs('jenfimail.instrumentation', level='INFO') as logs, CaptureQueriesContext(connection) as queries:
+                post_master_service.ship_train(self.train_thomas, line)
+                post_master_service.schedule_shipments(dry_run=True)
+            # batch reads are evaluated inside the call, so their query is counted there
+            with self.assertLogs('jenfimail.instrumentation', level='INFO') as status_logs:
+                parcel_service.get_parcel_statuses(list(Parcel.objects.values_list('id', flat=True)))
+        finally:
+            instrumentation.sample_rate = sample_rate
+
+        calls = [json.loads(record.getMessage()) for record in logs.records]
+        ship = [call for call in calls if call['name'] == 'PostMasterService.ship_train'][0]
+        schedule = [call for call in calls if call['name'] == 'PostMasterService.schedule_shipments'][0]
+        self.assertEqual(ship['status'], 'ok')
+        self.assertEqual(ship['queries'] + schedule['queries'], len(queries))
+        self.assertGreater(schedule['solver_ms'], 0)
+        self.assertEqual(ship['solver_ms'], 0)
+        self.assertEqual(json.loads(status_logs.records[0].getMessage())['queries'], 1)
+
+        metrics = instrumentation.registry.render()
+        self.assertIn('jenfimail_calls_total{kind="service",name="ParcelService.is_fillable",status="ok"}', metrics)
+        self.assertIn('jenfimail_db_queries_total{{kind="service",name="PostMasterService.ship_train"}} {}'.format(ship['queries']), metrics)
+        # the unsampled call is counted and timed, not measured
+        self.assertIn('jenfimail_call_duration_seconds_count{kind="service",name="ParcelService.is_fillable"}', metrics)
+        # optimizer helpers run under the entry point without series of their own
+        self.assertIn('name="OptimizerService.minimize_cost"', metrics)
+        self.assertNotIn('name="OptimizerService.build_model"', metrics)
+        self.assertNotIn('name="OptimizerService.run_model"', metrics)
+
+    def test_status_cache(self):
+        parcel_service.get_parcel_status(self.parcel_small1.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(parcel_service.get_parcel_status(self.parcel_small1.id)['status'], Parcel.STATUS_PENDING)
+
+        post_master_service.get_train_status(self.train_thomas.id)
+        shipment = post_master_service.ship_train(self.train_thomas, self.line_a)
+        parcel = shipment.parcels.first()
+        self.assertEqual(parcel_service.get_parcel_status(parcel.id)['status'], self.PARCEL_STATUS_IN_TRANSIT)
+        self.assertEqual(post_master_service.get_train_status(self.train_thomas.id)['line'], self.line_a.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(post_master_service.get_train_status(self.train_thomas.id)['departure_date'], shipment.departure_date)
+
+        # the async reads share the entries and their invalidation
+        with self.assertNumQueries(0):
+            self.assertEqual(async_to_sync(post_master_service.aget_train_status)(self.train_thomas.id)['line'], self.line_a.id)
+            self.assertEqual(async_to_sync(parcel_service.aget_parcel_status)(parcel.id)['status'], self.PARCEL_STATUS_IN_TRANSIT)
+        pending = Parcel.objects.filter(shipment=None, withdrawn_at=None).first()
+        self.assertEqual(async_to_sync(parcel_service.aget_parcel_status)(pending.id)['status'], Parcel.STATUS_PENDING)
+        parcel_service.withdraw_parcel(pending.id)
+        self.assertEqual(async_to_sync(parcel_service.aget_parcel_status)(pending.id)['status'], Parcel.STATUS_WITHDRAWN)
+
+        # in transit entries run out when the train arrives
+        for backend in [LocalStatusCacheBackend(), DjangoStatusCacheBackend()]:
+            cache = StatusCache(backend=backend, ttl_secs=60)
+            arrival_date = datetime.now(timezone.utc) + timedelta(milliseconds=50)
+            cache.get_parcel_status(parcel.id, lambda: ('in transit', arrival_date))
+            self.assertEqual(cache.get_parcel_status(parcel.id, lambda: ('shipped', None)), 'in transit')
+            time.sleep(0.1)
+            self.assertEqual(cache.get_parcel_status(parcel.id, lambda: ('shipped', None)), 'shipped')
+            cache.invalidate_parcels([parcel.id])
+            self.assertEqual(cache.get_parcel_status(parcel.id, lambda: ('withdrawn', None)), 'withdrawn')
+
+            async def aload():
+                return ('archived', None)
+            self.assertEqual(async_to_sync(cache.aget_parcel_status)(parcel.id, aload), 'withdrawn')
+            cache.invalidate_parcels([parcel.id])
+            self.assertEqual(async_to_sync(cache.aget_parcel_status)(parcel.id, aload), 'archived')
+            self.assertEqual(cache.get_parcel_status(parcel.id, lambda: ('withdrawn', None)), 'archived')
+
+    def test_optimize_invalid_solver(self):
+        self.assertRaises(SolverNotValidException, OptimizerService, solver='simplex')
+
+    def test_optimize_session(self):
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+
+        session = optimizer_service.create_session(lines, train_operator_service.get_available_trains(), parcels)
+        cost, schedule = session.resolve()
+        self.assertEqual(cost, optimizer_service.minimize_cost(lines, Train.objects.all(), parcels).cost)
+
+        train_operator_service.withdraw_train(self.train_james.id)
+        result = session.refresh(train_operator_service.get_available_trains(), parcels)
+        self.assertFalse(result.schedule)
+
+        train_gordon = train_operator_service.bid_train({
+            'name': 'Gordon (Big)',
+            'weight_capacity': 250,
+            'volume_capacity': 800,
+            'cost': 450,
+            'lines': [self.line_a.name]
+        })
+        cost, schedule = session.refresh(train_operator_service.get_available_trains(), parcels)
+        self.assertIn(train_gordon.id, [train.id for train, line in schedule])
+        self.assertNotIn(self.train_james.id, [train.id for train, line in schedule])
+        self.assertEqual(cost, optimizer_service.minimize_cost(lines, train_operator_service.get_available_trains(), parcels).cost)
+
+        session.update_parcel_load(1, 1)
+        cost, schedule = session.resolve()
+        self.assertEqual(cost, self.train_percy.cost)
+
+    def test_optimize_build_problem(self):
+        trains = Train.objects.all()
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)
+
+        with self.assertNumQueries(4):
+            problem = optimizer_service.build_problem(lines, trains, parcels)
+        self.assertEqual(problem.no_of_pairs, 5)
+        self.assertEqual(problem.parcel_weight, sum([p.weight for p in parcels]))
+        self.assertEqual(problem.parcel_volume, sum([p.volume for p in parcels]))
+
+        for i, line in enumerate(lines):
+            for j, train in enumerate(trains):
+                self.assertEqual(problem.incidence[i][j], 1 if line in train.lines.all() else 0)
+
+    def test_optimize_collapse_lines(self):
+        trains = Train.objects.all()
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+
+        problem = optimizer_service.build_problem(lines, trains, parcels)
+        model, x = optimizer_service.build_model(problem.collapse_lines())
+        self.assertEqual(len(x), 3)
+        self.assertEqual(len(model.constraints), 2)
+
+        schedule = optimizer_service.spread_lines(problem, [self.train_thomas, self.train_percy, self.train_james])
+        self.assertEqual([train.id for train, line in schedule], [self.train_thomas.id, self.train_percy.id, self.train_james.id])
+        self.assertEqual(len(set([line for train, line in schedule])), 3)
+        for train, line in schedule:
+            self.assertIn(line, [l.id for l in train.lines.all()])
+
+    def test_optimize_assignment(self):
+        trains = Train.objects.all()
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+        aggregate_cost = optimizer_service.minimize_cost(lines, trains, parcels).cost
+
+        exact = OptimizerService(time_limit=10).minimize_cost_assignment(lines, trains, parcels)
+        packed = OptimizerService(assignment_max_parcels=0).minimize_cost_assignment(lines, trains, parcels)
+        self.assertEqual(exact.status, 'Optimal')
+        self.assertEqual(packed.status, OptimizerService.STATUS_HEURISTIC)
+        self.assertEqual(exact.cost, aggregate_cost)
+        self.assertTrue(packed.cost >= exact.cost)
+
+        for result in [exact, packed]:
+            scheduled = { train.id: train for train, line in result.schedule }
+            self.assertEqual(sorted(sum(result.assignment.values(), [])), sorted([p.id for p in parcels]))
+            for train_id, parcel_ids in result.assignment.items():
+                loaded = Parcel.objects.filter(id__in=parcel_ids)
+                self.assertTrue(sum([p.weight for p in loaded]) <= scheduled[train_id].weight_capacity)
+                self.assertTrue(sum([p.volume for p in loaded]) <= scheduled[train_id].volume_capacity)
+
+        # the biggest parcel fits no train at all
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)
+        self.assertFalse(optimizer_service.minimize_cost_assignment(lines, trains, parcels).schedule)
+        self.assertFalse(OptimizerService(assignment_max_parcels=0).minimize_cost_assignment(lines, trains, parcels).schedule)
+
+    def test_schedule_shipments_dry_run(self):
+        plan = post_master_service.schedule_shipments(dry_run=True)
+        self.assertEqual(plan['status'], 'Optimal')
+        self.assertEqual(plan['total_cost'], sum([entry['cost'] for entry in plan['trains']]))
+        self.assertTrue([entry for entry in plan['trains'] if entry['dispatch'] and entry['parcels']])
+        self.assertFalse(Shipment.objects.exists())
+        self.assertEqual(len(train_operator_service.get_available_trains()), 3)
+
+        lines = [entry['line'] for entry in plan['trains'] if entry['dispatch']]
+        self.assertEqual(len(lines), len(set(lines)))
+
+    def test_schedule_shipments(self):
+        dry_plan = post_master_service.schedule_shipments(dry_run=True)
+        plan = post_master_service.schedule_shipments()
+        self.assertEqual(plan['total_cost'], dry_plan['total_cost'])
+
+        shipments = Shipment.objects.all()
+        self.assertEqual(len(shipments), len([entry for entry in plan['trains'] if entry['shipment']]))
+        for entry in plan['trains']:
+            if entry['shipment']:
+                shipment = Shipment.objects.get(pk=entry['shipment'])
+                self.assertEqual(shipment.line_id, entry['line'])
+                self.assertEqual(shipment.optimized_cost_per_weight, plan['cost_per_weight'])
+                self.assertEqual(shipment.weight, entry['weight'])
+
+    def test_optimize_timetable(self):
+        lines = Line.objects.all()
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None)[2:]
+        start = datetime.now(timezone.utc)
+
+        result = optimizer_service.minimize_cost_timetable(lines, Train.objects.all(), parcels, start=start)
+        self.assertEqual(result.status, 'Optimal')
+        self.assertEqual(result.cost, optimizer_service.minimize_cost(lines, Train.objects.all(), parcels).cost)
+        self.assertEqual(len(result.schedule), len(set([train.id for train, line, departure_date in result.schedule])))
+
+        # James alone cannot carry the load and A and B are busy, so James and Percy leave on C one travel window apart
+        parcel_service.deposit_parcel({ 'label': 'heavy', 'weight': 170, 'volume': 50 })
+        parcels = Parcel.objects.filter(withdrawn_at=None, shipment=None, volume__lte=100)
+        busy = { self.line_a.id: start + timedelta(days=1), self.line_b.id: start + timedelta(days=1) }
+        result = optimizer_service.minimize_cost_timetable(lines, Train.objects.all(), parcels, start=start, line_available_at=busy)
+        self.assertEqual([line for train, line, departure_date in result.schedule], [self.line_c.id, self.line_c.id])
+        first, second = [departure_date for train, line, departure_date in result.schedule]
+        self.assertEqual(first, start)
+        self.assertTrue(second - first >= timedelta(hours=settings.TRAIN_TRAVEL_TIME_HRS))
+
+    def test_schedule_shipments_multi_shift(self):
+        plan = post_master_service.schedule_shipments(multi_shift=True)
+        self.assertEqual(plan['status'], 'Optimal')
+        self.assertTrue([entry for entry in plan['trains'] if entry['shipment']])
+        self.assertEqual(Shipment.objects.count(), len([entry for entry in plan['trains'] if entry['shipment']]))
+
     def test_optimize_infeasible(self):
         trains = Train.objects.all()
         lines = Line.objects.all()
@@ -296,3 +786,84 @@ class PostMasterServiceTest(TestCase):
         cost, schedule = optimizer_service.minimize_cost(lines, trains, parcels)
         self.assertFalse(cost)
         self.assertFalse(schedule)
+
+@skipUnlessDBFeature('has_select_for_update_skip_locked')
+class ShipTrainConcurrencyTest(TransactionTestCase):
+    WORKERS = 8
+
+    def setUp(self):
+        line_availability_index.invalidate()
+        self.lines = [post_master_service.create_line({ 'name': 'line-{}'.format(i) }) for i in range(self.WORKERS)]
+        self.trains = [
+            train_operator_service.bid_train({
+                'name': 'train-{}'.format(i),
+                'weight_capacity': 40,
+                'volume_capacity': 400,
+                'cost': 100,
+                'lines': [line.name]
+            })
+            for i, line in enumerate(self.lines)
+        ]
+        parcel_service.deposit_parcels([{ 'label': 'parcel-{}'.format(i), 'weight': 1, 'volume': 1 } for i in range(400)])
+
+    def dispatch(self, jobs):
+        barrier = threading.Barrier(len(jobs))
+        results = []
+
+        def run(train, line):
+            try:
+                barrier.wait()
+                results.append(post_master_service.ship_train(train, line))
+            except Exception as e:
+                results.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=job) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_parallel_dispatch_no_double_assignment(self):
+        results = self.dispatch(list(zip(self.trains, self.lines)))
+        self.assertEqual(len([result for result in results if isinstance(result, Shipment)]), self.WORKERS)
+
+        shipped = Parcel.objects.exclude(shipment=None)
+        self.assertEqual(shipped.count(), 40 * self.WORKERS)
+        self.assertEqual(ShipmentParcel.objects.count(), shipped.count())
+        self.assertEqual(ShipmentParcel.objects.values('porcel').distinct().count(), shipped.count())
+        for shipment_id, porcel_id in ShipmentParcel.objects.values_list('shipment_id', 'porcel_id'):
+            self.assertEqual(Parcel.objects.get(pk=porcel_id).shipment_id, shipment_id)
+
+    def test_parallel_dispatch_same_line(self):
+        train = train_operator_service.bid_train({
+            'name': 'train-same-line',
+            'weight_capacity': 40,
+            'volume_capacity': 400,
+            'cost': 100,
+            'lines': [self.lines[0].name]
+        })
+        results = self.dispatch([(self.trains[0], self.lines[0]), (train, self.lines[0])])
+        self.assertEqual(len([result for result in results if isinstance(result, Shipment)]), 1)
+        self.assertEqual(len([result for result in results if isinstance(result, LineNotAvailableException)]), 1)
+
+class BenchTest(TestCase):
+    def test_generator_seeded(self):
+        self.assertEqual(BenchDataGenerator(seed=7).parcel_data(50), BenchDataGenerator(seed=7).parcel_data(50))
+        self.assertNotEqual(BenchDataGenerator(seed=7).parcel_data(50), BenchDataGenerator(seed=8).parcel_data(50))
+
+    def test_bench_command(self):
+        stdout = StringIO()
+        call_command('bench', '--current-db', '--parcels', '300', '--trains', '5', '--lines', '3', '--repeat', '1', '--warmup', '0', '--no-memory', stdout=stdout, stderr=StringIO())
+        report = json.loads(stdout.getvalue())
+
+        self.assertEqual(report['meta']['parcels'], 300)
+        results = { result['name']: result for result in report['results'] }
+        self.assertIn('PostMasterService.ship_train', results)
+        self.assertEqual(results['ParcelService.get_parcel_statuses']['queries'], 1)
+        self.assertIsNotNone(results['OptimizerService.minimize_cost']['solver_ms'])
+
+        # every case ran in a rolled back transaction
+        self.assertEqual(Parcel.objects.count(), 300)
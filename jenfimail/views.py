@@ -1,19 +1,43 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.http import require_GET
+from django.db.models import prefetch_related_objects
 from django.views import View
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status, viewsets
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, parser_classes
+from rest_framework.parsers import JSONParser
+from rest_framework.exceptions import NotFound
 
-from .services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService
+from .services import TrainOperatorService, PostMasterService, ParcelService, OptimizerService, ExportService
 from .models import Train, Line, Parcel
-from .serializers import LineSerializer, TrainSerializer, ParcelSerializer, ShipmentSerializer
+from .serializers import LineSerializer, TrainSerializer, ParcelSerializer, ArchivedParcelSerializer, ShipmentSerializer
+from .parsers import NDJSONParser
+from .pagination import KeysetPagination
+from .custom_exceptions import StatusIdsNotValidException
+from .instrumentation import instrumentation
 
 train_operator_service = TrainOperatorService()
 parcel_service = ParcelService()
 optimizer_service = OptimizerService()
 post_master_service = PostMasterService(train_operator_service, parcel_service, optimizer_service)
+export_service = ExportService()
+
+STATUS_BATCH_MAX = 5000
+
+def is_truthy(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def get_projection(request):
+    return parse_fields(request.query_params.get('fields'))
+
+def get_async_projection(request):
+    return parse_fields(request.GET.get('fields'))
+
+def parse_fields(fields):
+    return [field.strip() for field in fields.split(',') if field.strip()] if fields else None
 
 @api_view(('GET',))
 def index(request):
@@ -51,11 +75,22 @@ def ship_train(request, train_id, line_id):
         train = Train.objects.get(pk=train_id)
         line = Line.objects.get(pk=line_id)
         shipment = post_master_service.ship_train(train, line, request.data.get('optimized_cost_per_weight'))
+        prefetch_related_objects([shipment], ShipmentSerializer.get_parcels_prefetch())
         serializer = ShipmentSerializer(shipment)
         return Response(serializer.data, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({ 'error': str(e)  }, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(('POST',))
+def schedule_shipments(request):
+    dry_run = is_truthy(request.data.get('dry_run', request.query_params.get('dry_run')))
+    multi_shift = is_truthy(request.data.get('multi_shift', request.query_params.get('multi_shift')))
+    try:
+        plan = post_master_service.schedule_shipments(dry_run=dry_run, multi_shift=multi_shift)
+        return Response(plan, status=status.HTTP_200_OK)
+    except Exception as e:
+        return Response({ 'error': str(e)  }, status=status.HTTP_400_BAD_REQUEST)
+
 @api_view(('GET',))
 def get_train_status(request, train_id):
     try:
@@ -79,6 +114,34 @@ def deposit_parcel(request):
 
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(('POST',))
+@parser_classes((JSONParser, NDJSONParser))
+def deposit_parcels(request):
+    if not isinstance(request.data, list):
+        return Response({ 'error': 'expected a list of parcels' }, status=status.HTTP_400_BAD_REQUEST)
+
+    items = [
+        {
+            'label': item.get('label'),
+            'weight': item.get('weight'),
+            'volume': item.get('volume'),
+        } if isinstance(item, dict) else item
+        for item in request.data
+    ]
+    serializer = ParcelSerializer(data=items, many=True)
+    serializer.is_valid()
+
+    # invalid rows are reported by index, the rest are still deposited
+    errors = serializer.errors if serializer.errors else [{}] * len(items)
+    valid = [i for i, error in enumerate(errors) if not error]
+    parcels = parcel_service.deposit_parcels([items[i] for i in valid])
+
+    result = {
+        'ids': [parcel.id for parcel in parcels],
+        'errors': [{ 'index': i, 'errors': error } for i, error in enumerate(errors) if error],
+    }
+    return Response(result, status=status.HTTP_201_CREATED if parcels else status.HTTP_400_BAD_REQUEST)
+
 @api_view(('POST',))
 def withdraw_parcel(request, parcel_id):
     try:
@@ -91,16 +154,148 @@ def withdraw_parcel(request, parcel_id):
 @api_view(('GET',))
 def get_parcel_status(request, parcel_id):
     try:
-        parcel = Parcel.objects.get(pk=parcel_id)
-        serializer = ParcelSerializer(parcel)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        result = parcel_service.get_parcel_status(parcel_id)
+        return Response(result, status=status.HTTP_200_OK)
     except Exception as e:
         return Response({ 'error': str(e)  }, status=status.HTTP_400_BAD_REQUEST)
 
+def get_status_ids(request):
+    # ?ids=1,2,3 on GET, { "ids": [1, 2, 3] } on POST for sets too long for a url
+    if request.method == 'POST':
+        ids = request.data.get('ids') if isinstance(request.data, dict) else None
+    else:
+        ids = request.query_params.get('ids', '').split(',')
+        ids = [value for value in ids if value.strip()]
+
+    if not isinstance(ids, list) or not ids or len(ids) > STATUS_BATCH_MAX:
+        raise StatusIdsNotValidException()
+    try:
+        return list(set([int(value) for value in ids]))
+    except (TypeError, ValueError):
+        raise StatusIdsNotValidException()
+
+@api_view(('GET', 'POST'))
+def get_parcel_statuses(request):
+    try:
+        ids = get_status_ids(request)
+    except StatusIdsNotValidException as e:
+        return Response({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+    parcels = parcel_service.get_parcel_statuses(ids)
+    results = ParcelSerializer(parcels, many=True, fields=get_projection(request)).data
+    missing = set(ids) - set([parcel.id for parcel in parcels])
+    if missing:
+        # the rest may have been archived already
+        archived = parcel_service.get_archived_parcel_statuses(missing)
+        results += ArchivedParcelSerializer(archived, many=True, fields=get_projection(request)).data
+        missing -= set([parcel.id for parcel in archived])
+    return Response({ 'results': results, 'missing': sorted(missing) }, status=status.HTTP_200_OK)
+
+@api_view(('GET', 'POST'))
+def get_train_statuses(request):
+    try:
+        ids = get_status_ids(request)
+    except StatusIdsNotValidException as e:
+        return Response({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+    statuses = post_master_service.get_train_statuses(ids)
+    found = set([train['id'] for train in statuses])
+    return Response({ 'results': statuses, 'missing': sorted(set(ids) - found) }, status=status.HTTP_200_OK)
+
+def get_export_params(request, filter_names):
+    export_format = request.GET.get('format', ExportService.FORMAT_NDJSON)
+    if export_format not in ExportService.FORMATS:
+        raise ValueError('format must be one of: {}'.format(', '.join(ExportService.FORMATS)))
+
+    filters = {}
+    for name in filter_names:
+        value = request.GET.get(name)
+        if value is None:
+            continue
+        filters[name] = parse_datetime(value)
+        if not filters[name]:
+            raise ValueError('{} is not a valid datetime'.format(name))
+
+    return export_format, filters
+
+def stream_export(rows, export_format, name):
+    response = StreamingHttpResponse(rows, content_type=ExportService.CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename="{name}.{ext}"'.format(name=name, ext=export_format)
+    return response
+
+# plain django views: DRF would treat ?format= as a renderer override
+@require_GET
+def export_parcels(request):
+    try:
+        export_format, filters = get_export_params(request, ExportService.PARCEL_FILTERS)
+    except ValueError as e:
+        return JsonResponse({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+    return stream_export(export_service.export_parcels(filters, export_format), export_format, 'parcels')
+
+@require_GET
+def export_shipments(request):
+    try:
+        export_format, filters = get_export_params(request, ExportService.SHIPMENT_FILTERS)
+    except ValueError as e:
+        return JsonResponse({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+    return stream_export(export_service.export_shipments(filters, export_format), export_format, 'shipments')
+
+@require_GET
+def metrics(request):
+    # per process: scrape every worker, or run a single one behind the scraper
+    return HttpResponse(instrumentation.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# async views for the read-heavy polling endpoints; DRF views are sync only, so these are plain django views
+async def aget_parcel_status(request, parcel_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        result = await parcel_service.aget_parcel_status(parcel_id)
+        return JsonResponse(result, status=status.HTTP_200_OK)
+    except Exception as e:
+        return JsonResponse({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+async def aget_train_status(request, train_id):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    try:
+        result = await post_master_service.aget_train_status(train_id)
+        return JsonResponse(result, status=status.HTTP_200_OK)
+    except Exception as e:
+        return JsonResponse({ 'error': str(e) }, status=status.HTTP_400_BAD_REQUEST)
+
+async def alist_trains(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    paginator = KeysetPagination(ordering=['id'])
+    try:
+        trains = await paginator.apaginate_queryset(TrainSerializer.setup_eager_loading(Train.objects.all()), request)
+    except NotFound as e:
+        return JsonResponse({ 'detail': str(e.detail) }, status=status.HTTP_404_NOT_FOUND)
+    serializer = TrainSerializer(trains, many=True, fields=get_async_projection(request))
+    return JsonResponse(paginator.get_paginated_data(serializer.data), status=status.HTTP_200_OK)
+
+async def alist_parcels(request):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    paginator = KeysetPagination(ordering=['created_at', 'id'])
+    try:
+        parcels = await paginator.apaginate_queryset(ParcelSerializer.setup_eager_loading(Parcel.objects.all()), request)
+    except NotFound as e:
+        return JsonResponse({ 'detail': str(e.detail) }, status=status.HTTP_404_NOT_FOUND)
+    serializer = ParcelSerializer(parcels, many=True, fields=get_async_projection(request))
+    return JsonResponse(paginator.get_paginated_data(serializer.data), status=status.HTTP_200_OK)
+
 class LineView(APIView):
 
     def get(self, request):
-        lines = Line.objects.all()
+        lines = LineSerializer.setup_eager_loading(Line.objects.all())
         serializer = LineSerializer(lines, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -120,9 +315,10 @@ class LineView(APIView):
 class TrainView(APIView):
 
     def get(self, request):
-        trains = Train.objects.all()
-        serializer = TrainSerializer(trains, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = KeysetPagination(ordering=['id'])
+        trains = paginator.paginate_queryset(TrainSerializer.setup_eager_loading(Train.objects.all()), request)
+        serializer = TrainSerializer(trains, many=True, fields=get_projection(request))
+        return paginator.get_paginated_response(serializer.data)
 
     def post(self, request):
         data = {
@@ -143,9 +339,10 @@ class TrainView(APIView):
 class ParcelView(APIView):
 
     def get(self, request):
-        parcels = Parcel.objects.all()
-        serializer = ParcelSerializer(parcels, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        paginator = KeysetPagination(ordering=['created_at', 'id'])
+        parcels = paginator.paginate_queryset(ParcelSerializer.setup_eager_loading(Parcel.objects.all()), request)
+        serializer = ParcelSerializer(parcels, many=True, fields=get_projection(request))
+        return paginator.get_paginated_response(serializer.data)
 
     def post(self, request):
         data = {